@@ -0,0 +1,60 @@
+# compares media processing before and after processImage on a directory of images
+# usage: python benchmarks/benchmark_media.py <directory> [runs]
+# mediasizes and mediaformats are read from the environment like the function app, unset means the app defaults
+
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import function_app
+
+
+def resizeImage(img, size, quality):
+    # the per size resize uploadmedia used before processImage, decoding the full upload every time
+    from PIL import Image
+    newimg = Image.open(img)
+    newimg.thumbnail(size)
+    outimg = BytesIO()
+    newimg.save(outimg, optimize=True, quality=quality, format="JPEG")
+    return outimg.getvalue()
+
+def separateDecodes(upload):
+    return {name: resizeImage(BytesIO(upload), (pixels, pixels), quality) for name, pixels, quality in function_app.mediaSizes()}
+
+def timeRuns(function, upload, runs):
+    start = time.perf_counter()
+    for i in range(runs):
+        function(upload)
+    return (time.perf_counter() - start) / runs
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python benchmarks/benchmark_media.py <directory> [runs]")
+        return 1
+    directory = sys.argv[1]
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    files = sorted([f for f in os.listdir(directory) if f.lower().endswith((".jpg", ".jpeg"))])
+    if len(files) == 0:
+        print("no jpeg files in " + directory)
+        return 1
+    totals = {"separate": 0.0, "processImage": 0.0}
+    print("file, megapixels, separate decodes s, processImage s")
+    for f in files:
+        from PIL import Image
+        with open(os.path.join(directory, f), "rb") as fh:
+            upload = fh.read()
+        megapixels = Image.open(BytesIO(upload)).size
+        megapixels = megapixels[0] * megapixels[1] / 1000000
+        separate = timeRuns(separateDecodes, upload, runs)
+        processed = timeRuns(function_app.processImage, upload, runs)
+        totals["separate"] += separate
+        totals["processImage"] += processed
+        print(f + ", " + str(round(megapixels, 1)) + ", " + str(round(separate, 3)) + ", " + str(round(processed, 3)))
+    print("mean, , " + str(round(totals["separate"] / len(files), 3)) + ", " + str(round(totals["processImage"] / len(files), 3)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
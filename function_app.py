@@ -6,18 +6,36 @@ import time
 import json
 import uuid
 import hashlib
+import base64
 import secrets
 import string
 import math
 import html
+import tempfile
+import threading
+import concurrent.futures
+import functools
+import typing
+from collections import OrderedDict
 import azure.functions as func
 from io import BytesIO
 from dateutil import parser
 from azure.storage.blob import BlobServiceClient, ContentSettings
-from azure.data.tables import TableServiceClient
+from azure.data.tables import TableServiceClient, UpdateMode, TableTransactionError
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError, HttpResponseError
+from azure.core import MatchConditions
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)\
 
+# storage clients are created once per worker and reused so warm invocations share a keep-alive connection pool
+storageclients = {}
+storageclientslock = threading.Lock()
+
+# in-process caches, entries are only shared within a worker so every cache has a ttl
+caches = {}
+cacheslock = threading.Lock()
+connectionversions = {}
+
 def createJsonHttpResponse(statuscode, message, properties = {}, headers = {}):
     response = {}
     response["statuscode"] = statuscode
@@ -56,122 +74,519 @@ def parseActivityData(geojson):
             activitydata.append(properties)
     return {"version": 1, "data": activitydata}
 
-def parseStatisticsData(in_activitydata):
+def activityDataColumns(in_activitydata):
+    import numpy
+
+    columns = {}
+    columns["timestamp"] = [d["timestamp"] for d in in_activitydata]
+    columns["longitude"] = numpy.fromiter((d["longitude"] for d in in_activitydata), dtype=numpy.float64, count=len(in_activitydata))
+    columns["latitude"] = numpy.fromiter((d["latitude"] for d in in_activitydata), dtype=numpy.float64, count=len(in_activitydata))
+    columns["elevation"] = numpy.fromiter((d.get("elevation", numpy.nan) for d in in_activitydata), dtype=numpy.float64, count=len(in_activitydata))
+    return columns
+
+def segmentDistances(longitude, latitude, mode = None):
+    # geodesic is exact (same algorithm as geographiclib) and batched through pyproj
+    # haversine is a faster spherical approximation, typically within 0.5% of geodesic
+    import numpy
+
+    if mode == None:
+        mode = os.environ.get("distancemode", "geodesic")
+    match mode:
+        case "geodesic":
+            from pyproj import Geod
+            azimuth1, azimuth2, distances = Geod(ellps="WGS84").inv(longitude[:-1], latitude[:-1], longitude[1:], latitude[1:])
+            return numpy.asarray(distances)
+        case "haversine":
+            lon1 = numpy.radians(longitude[:-1])
+            lat1 = numpy.radians(latitude[:-1])
+            lon2 = numpy.radians(longitude[1:])
+            lat2 = numpy.radians(latitude[1:])
+            a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+            return 2 * 6371008.8 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+        case _:
+            raise Exception("invalid distancemode, must be geodesic or haversine")
+
+def fillElevation(elevation):
+    # missing elevations are interpolated from the neighbouring points, and held at the nearest one at either end,
+    # so a gap adds no climb or drop, a track without any elevation is flat at 0
+    import numpy
+
+    missing = numpy.isnan(elevation)
+    if not missing.any():
+        return elevation
+    if missing.all():
+        return numpy.zeros(len(elevation))
+    index = numpy.arange(len(elevation))
+    return numpy.interp(index, index[~missing], elevation[~missing])
+
+def smoothElevation(elevation, smoothing):
+    # moving average over [i - smoothing, i + smoothing) using a cumulative sum, last point is left as is
+    import numpy
+
+    count = len(elevation)
+    if smoothing <= 0 or count < 2:
+        return elevation
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(elevation)))
+    index = numpy.arange(count - 1)
+    low = numpy.maximum(index - smoothing, 0)
+    high = numpy.minimum(index + smoothing, count - 1)
+    smoothed = numpy.round((cumulative[high] - cumulative[low]) / (high - low))
+    return numpy.concatenate((smoothed, elevation[-1:]))
+
+def parseIsoTimestamp(timestamp):
+    # datetime.fromisoformat is much faster than dateutil, isoparse covers the forms it rejects on older pythons
+    try:
+        if timestamp.endswith("Z"):
+            parsed = datetime.datetime.fromisoformat(timestamp[:-1] + "+00:00")
+        else:
+            parsed = datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        parsed = parser.isoparse(timestamp)
+    if parsed.tzinfo == None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+def parseGpxColumns(upload):
+    # streams trkpt elements straight into columns, returns None if the gpx cannot be read this way
+    import xml.etree.ElementTree as ElementTree
+    from array import array
+    import numpy
+
+    timestamps = []
+    times = array("d")
+    longitudes = array("d")
+    latitudes = array("d")
+    elevations = array("d")
+    priortime = parseIsoTimestamp("2020-01-01T00:00:00+00:00").timestamp()
+    try:
+        for event, element in ElementTree.iterparse(BytesIO(upload), events=("end",)):
+            if element.tag.rsplit("}", 1)[-1] != "trkpt":
+                continue
+            timestamp = None
+            elevation = float("nan")
+            for child in element:
+                match child.tag.rsplit("}", 1)[-1]:
+                    case "time":
+                        timestamp = (child.text or "").strip()
+                    case "ele":
+                        # an empty or unreadable ele leaves the point without elevation, as the geojson path did
+                        try:
+                            elevation = max(float(child.text), 0)
+                        except (TypeError, ValueError):
+                            elevation = float("nan")
+            try:
+                currenttime = parseIsoTimestamp(timestamp).timestamp()
+                longitude = float(element.attrib["lon"])
+                latitude = float(element.attrib["lat"])
+            except:
+                raise Exception("Could not parse timestamp, longitude, or latitude which are required")
+            if priortime > currenttime:
+                raise Exception("Error: Detected out of order timestamp data")
+            priortime = currenttime
+            timestamps.append(timestamp)
+            times.append(currenttime)
+            longitudes.append(longitude)
+            latitudes.append(latitude)
+            elevations.append(elevation)
+            element.clear()
+    except ElementTree.ParseError:
+        return None
+    if len(timestamps) == 0:
+        return None
+    return {
+        "timestamp": timestamps,
+        "time": numpy.frombuffer(times, dtype=numpy.float64),
+        "longitude": numpy.frombuffer(longitudes, dtype=numpy.float64),
+        "latitude": numpy.frombuffer(latitudes, dtype=numpy.float64),
+        "elevation": numpy.frombuffer(elevations, dtype=numpy.float64)
+    }
+
+def parseFitColumns(upload):
+    # record messages go straight into columns, heartrate, cadence and power are only kept when the file has them
+    from garmin_fit_sdk import Decoder, Stream
+    from array import array
+    import numpy
+
+    messages, errors = Decoder(Stream.from_bytes_io(BytesIO(upload))).read()
+    timestamps = []
+    buffers = {}
+    for name in ["time", "longitude", "latitude", "elevation", "heartrate", "cadence", "power"]:
+        buffers[name] = array("d")
+    channels = {"heartrate": "heart_rate", "cadence": "cadence", "power": "power"}
+    present = set()
+    for m in messages.get("record_mesgs", []):
+        timestamp = m.get("timestamp")
+        longitude = m.get("position_long")
+        latitude = m.get("position_lat")
+        if timestamp == None or longitude == None or latitude == None:
+            continue
+        elevation = m.get("enhanced_altitude", m.get("altitude"))
+        timestamps.append(timestamp.isoformat())
+        buffers["time"].append(timestamp.timestamp())
+        buffers["longitude"].append(longitude / 11930465)
+        buffers["latitude"].append(latitude / 11930465)
+        buffers["elevation"].append(float(elevation) if elevation != None else 0)
+        for name, field in channels.items():
+            value = m.get(field)
+            if value != None:
+                present.add(name)
+                buffers[name].append(value)
+            else:
+                buffers[name].append(numpy.nan)
+    columns = {"timestamp": timestamps}
+    for name, buffer in buffers.items():
+        if name not in channels or name in present:
+            columns[name] = numpy.frombuffer(buffer, dtype=numpy.float64)
+    return columns
+
+def columnsToActivityData(columns):
+    activitydata = []
+    elevations = columns["elevation"].tolist()
+    for timestamp, longitude, latitude, elevation in zip(columns["timestamp"], columns["longitude"].tolist(), columns["latitude"].tolist(), elevations):
+        properties = {"timestamp": timestamp, "longitude": longitude, "latitude": latitude}
+        if not math.isnan(elevation):
+            properties["elevation"] = elevation
+        activitydata.append(properties)
+    for name in ["heartrate", "cadence", "power"]:
+        if name in columns:
+            for properties, value in zip(activitydata, columns[name].tolist()):
+                if not math.isnan(value):
+                    properties[name] = value
+    return {"version": 1, "data": activitydata}
 
-    from geographiclib.geodesic import Geodesic
-    import statistics
-    import copy
+def parseStatisticsColumns(columns, mode = None):
+    import numpy
 
-    sactivitydata = copy.deepcopy(in_activitydata)
     statisticsdata = {}
 
-    mintime = parser.parse(sactivitydata[0]["timestamp"])
-    maxtime = parser.parse(sactivitydata[len(sactivitydata)-1]["timestamp"])
+    mintime = parser.parse(columns["timestamp"][0])
+    maxtime = parser.parse(columns["timestamp"][len(columns["timestamp"])-1])
+
+    elevation = smoothElevation(fillElevation(numpy.asarray(columns["elevation"], dtype=numpy.float64)), int(os.environ["smoothing"]))
+    elevationdelta = numpy.diff(elevation)
 
-    time = (maxtime - mintime).seconds
     distance = 0.0
-    ascent = 0.0
-    descent = 0.0
-
-    smoothing = int(os.environ["smoothing"])
-    if smoothing > 0:
-        for i in range(len(sactivitydata)-1):
-            filterdata = []
-            for j in range(max(i - smoothing, 0), min(i + smoothing, len(sactivitydata)-1)):
-                filterdata.append(sactivitydata[j]["elevation"])
-            sactivitydata[i]["elevation"] = round(statistics.mean(filterdata))
-
-    for i in range(len(sactivitydata)-1):
-        x1 = sactivitydata[i]["longitude"]
-        y1 = sactivitydata[i]["latitude"]
-        x2 = sactivitydata[i+1]["longitude"]
-        y2 = sactivitydata[i+1]["latitude"]
-        distance += Geodesic.WGS84.Inverse(y1, x1, y2, x2)['s12']
-        if (sactivitydata[i+1]["elevation"] > sactivitydata[i]["elevation"]):
-            ascent += sactivitydata[i+1]["elevation"] - sactivitydata[i]["elevation"]
-        else:
-            descent += sactivitydata[i]["elevation"] - sactivitydata[i+1]["elevation"]
+    if len(columns["longitude"]) > 1:
+        distance = float(numpy.sum(segmentDistances(numpy.asarray(columns["longitude"], dtype=numpy.float64), numpy.asarray(columns["latitude"], dtype=numpy.float64), mode)))
 
     statisticsdata["starttime"] = mintime
-    statisticsdata["time"] = time
+    statisticsdata["time"] = (maxtime - mintime).seconds
     statisticsdata["distance"] = distance
-    statisticsdata["ascent"] = ascent
-    statisticsdata["descent"] = descent
+    statisticsdata["ascent"] = float(numpy.sum(elevationdelta[elevationdelta > 0]))
+    statisticsdata["descent"] = float(numpy.sum(-elevationdelta[elevationdelta < 0]))
 
     statisticsdata["version"] = 1
 
     return statisticsdata
 
-def saveBlob(data, name, contenttype = None):
-    blobserviceclient = BlobServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-    blobclient = blobserviceclient.get_blob_client(os.environ["storagecontainer"], name)
-    if (contenttype != None):
-        content_settings = ContentSettings(content_type=contenttype)
+def parseStatisticsData(in_activitydata, mode = None):
+    return parseStatisticsColumns(activityDataColumns(in_activitydata), mode)
+
+def getStorageTransport():
+    from azure.core.pipeline.transport import RequestsTransport
+    import requests
+    with storageclientslock:
+        if "transport" not in storageclients:
+            poolsize = int(os.environ.get("storagepoolsize", "20"))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            storageclients["transport"] = RequestsTransport(
+                session=session,
+                session_owner=False,
+                connection_timeout=float(os.environ.get("storageconnectiontimeout", "10")),
+                read_timeout=float(os.environ.get("storagereadtimeout", "60")))
+        return storageclients["transport"]
+
+def getBlobServiceClient():
+    transport = getStorageTransport()
+    with storageclientslock:
+        if "blobservice" not in storageclients:
+            storageclients["blobservice"] = BlobServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"], transport=transport)
+        return storageclients["blobservice"]
+
+def getTableServiceClient():
+    transport = getStorageTransport()
+    with storageclientslock:
+        if "tableservice" not in storageclients:
+            storageclients["tableservice"] = TableServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"], transport=transport)
+        return storageclients["tableservice"]
+
+def getContainerClient(container = None):
+    if container == None:
+        container = os.environ["storagecontainer"]
+    blobserviceclient = getBlobServiceClient()
+    with storageclientslock:
+        if "container:" + container not in storageclients:
+            storageclients["container:" + container] = blobserviceclient.get_container_client(container)
+        return storageclients["container:" + container]
+
+def getTableClient(table):
+    tableserviceclient = getTableServiceClient()
+    with storageclientslock:
+        if "table:" + table not in storageclients:
+            storageclients["table:" + table] = tableserviceclient.get_table_client(table)
+        return storageclients["table:" + table]
+
+def encodeContent(data, encoding):
+    match encoding:
+        case "gzip":
+            import gzip
+            return gzip.compress(data)
+        case "br":
+            import brotli
+            return brotli.compress(data)
+        case None | "identity":
+            return data
+        case _:
+            raise Exception("unsupported content encoding " + str(encoding))
+
+def decodeContent(data, encoding):
+    match encoding:
+        case "gzip":
+            import gzip
+            return gzip.decompress(data)
+        case "br":
+            import brotli
+            return brotli.decompress(data)
+        case None | "" | "identity":
+            return data
+        case _:
+            raise Exception("unsupported content encoding " + str(encoding))
+
+def saveBlob(data, name, contenttype = None, compress = False):
+    # compress stores the blob with the blobencoding setting as its content encoding, getBlob decodes it transparently
+    blobclient = getContainerClient().get_blob_client(name)
+    contentencoding = None
+    if compress and os.environ.get("blobencoding", "gzip") != "identity":
+        contentencoding = os.environ.get("blobencoding", "gzip")
+        data = encodeContent(data, contentencoding)
+    if (contenttype != None or contentencoding != None):
+        content_settings = ContentSettings(content_type=contenttype, content_encoding=contentencoding)
         blobclient.upload_blob(data, overwrite=True, content_settings=content_settings)
     else:
         blobclient.upload_blob(data, overwrite=True)
 
-def getBlob(name):
+def getBlob(name, decompress = True, conditions = None, byterange = None, maxsize = None):
+    # with decompress False the stored bytes are returned as is along with their contentencoding
+    # conditions may hold an etag or modifiedsince, a matching blob is not downloaded and comes back as notmodified
+    # byterange is (start, end) with end inclusive or None, a negative start is a suffix length, ranges are capped at datamaxrange
+    # without a byterange, blobs larger than maxsize are not read past the first response and come back as toolarge
+    kwargs = {}
+    if conditions != None and conditions.get("etag") != None:
+        kwargs["etag"] = conditions["etag"]
+        kwargs["match_condition"] = MatchConditions.IfModified
+    elif conditions != None and conditions.get("modifiedsince") != None:
+        kwargs["if_modified_since"] = conditions["modifiedsince"]
     try:
-        blobserviceclient = BlobServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-        blobclient = blobserviceclient.get_blob_client(os.environ["storagecontainer"], name)
-        blob = blobclient.download_blob()
-        data = BytesIO()
+        blobclient = getContainerClient().get_blob_client(name)
+        if byterange != None:
+            start, end = byterange
+            if start < 0:
+                start = max(blobclient.get_blob_properties().size + start, 0)
+                end = None
+            length = int(os.environ.get("datamaxrange", str(4 * 1024 * 1024)))
+            if end != None:
+                length = min(end - start + 1, length)
+            kwargs["offset"] = start
+            kwargs["length"] = length
+        blob = blobclient.download_blob(decompress=False, **kwargs)
+        if maxsize != None and byterange == None and blob.size > maxsize:
+            return {"data": None, "contenttype": None, "contentencoding": None, "size": blob.size, "toolarge": True, "status": False}
         data = blob.readall()
-        return {"data": data, "contenttype": blob.properties.content_settings["content_type"], "status": True}
+        contentencoding = blob.properties.content_settings["content_encoding"]
+        if decompress and contentencoding not in [None, ""] and byterange == None:
+            data = decodeContent(data, contentencoding)
+            contentencoding = None
+        gb = {"data": data, "contenttype": blob.properties.content_settings["content_type"], "contentencoding": contentencoding or None, "etag": blob.properties.etag, "lastmodified": blob.properties.last_modified, "notmodified": False, "range": None, "status": True}
+        if byterange != None:
+            gb["range"] = (kwargs["offset"], kwargs["offset"] + len(data) - 1, int(blob.properties.content_range.split("/")[-1]))
+        return gb
+    except HttpResponseError as ex:
+        if isinstance(ex, ResourceNotModifiedError) or ex.status_code == 304:
+            return {"data": None, "contenttype": None, "contentencoding": None, "etag": kwargs.get("etag"), "lastmodified": None, "notmodified": True, "range": None, "status": True}
+        if isinstance(ex, ResourceNotFoundError):
+            return {"data": None, "contenttype": None, "contentencoding": None, "notfound": True, "status": False}
+        if ex.status_code == 416:
+            try:
+                size = blobclient.get_blob_properties().size
+            except:
+                return {"data": None, "contenttype": None, "contentencoding": None, "status": False}
+            return {"data": None, "contenttype": None, "contentencoding": None, "etag": None, "lastmodified": None, "notmodified": False, "range": (None, None, size), "status": True}
+        return {"data": None, "contenttype": None, "contentencoding": None, "status": False}
     except:
-        return {"data": None, "contenttype": None, "status": False}
+        return {"data": None, "contenttype": None, "contentencoding": None, "status": False}
+
+def requestRange(req):
+    # a single bytes range from the Range header as (start, end), multiple or malformed ranges are ignored
+    header = req.headers.get("Range", "").strip()
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start, separator, end = header[6:].strip().partition("-")
+    try:
+        if len(start) == 0:
+            if int(end) <= 0:
+                return None
+            return (-int(end), None)
+        if len(end) == 0:
+            return (int(start), None)
+        if int(end) < int(start):
+            return None
+        return (int(start), int(end))
+    except ValueError:
+        return None
+
+def getCachedBlob(name, conditions = None):
+    # small immutable blobs are kept in a per worker lru bounded by blobcachemb, missing blobs are remembered for blobnegativecachettl
+    cg = cacheGet("blobs", name)
+    if cg["status"]:
+        gb = cg["value"]
+    else:
+        gb = getBlob(name)
+        if gb["status"] and len(gb["data"]) <= int(os.environ.get("blobcachemaxkb", "256")) * 1024:
+            cacheSet("blobs", name, gb, int(os.environ.get("blobcachettl", "3600")), size=len(gb["data"]), maxbytes=int(os.environ.get("blobcachemb", "64")) * 1024 * 1024)
+        elif gb.get("notfound"):
+            cacheSet("blobs", name, gb, int(os.environ.get("blobnegativecachettl", "30")), size=len(name))
+    if not gb["status"] or conditions == None:
+        return gb
+    if conditions.get("etag") != None and conditions["etag"] == gb["etag"]:
+        notmodified = True
+    elif conditions.get("modifiedsince") != None and gb["lastmodified"] != None and gb["lastmodified"].replace(microsecond=0) <= conditions["modifiedsince"]:
+        notmodified = True
+    else:
+        notmodified = False
+    if notmodified:
+        return {"data": None, "contenttype": None, "contentencoding": None, "etag": gb["etag"], "lastmodified": gb["lastmodified"], "notmodified": True, "range": None, "status": True}
+    return gb
 
 def deleteBlob(name):
+    cacheInvalidate("blobs", [name])
     try:
-        blobserviceclient = BlobServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-        blobclient = blobserviceclient.get_blob_client(os.environ["storagecontainer"], name)
+        blobclient = getContainerClient().get_blob_client(name)
         blobclient.delete_blob()
     except:
         return False
     return True
 
 def listBlobs(startswith):
-    blobserviceclient = BlobServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-    containerclient = blobserviceclient.get_container_client(os.environ["storagecontainer"])
+    containerclient = getContainerClient()
     blobs = containerclient.list_blobs(startswith)
     bloblist = []
     for b in blobs:
         bloblist.append(b)
     return bloblist
 
+def deleteBlobs(names):
+    # blob batch requests take up to 256 deletes, batches run concurrently and blobs already gone are ignored
+    cacheInvalidate("blobs", names)
+    containerclient = getContainerClient()
+    executor = getQueryExecutor()
+    futures = [executor.submit(deleteBlobBatch, containerclient, batch) for batch in splitList(names, 256)]
+    for future in futures:
+        future.result()
+
+def deleteBlobBatch(containerclient, batch):
+    # each delete in a batch has its own response, anything but deleted or not found fails the batch
+    failures = []
+    for name, response in zip(batch, containerclient.delete_blobs(*batch, raise_on_any_failure=False)):
+        if response.status_code not in [202, 404]:
+            failures.append(name + " (" + str(response.status_code) + ")")
+    if len(failures) > 0:
+        raise Exception("blobs not deleted: " + ", ".join(failures))
+
 def upsertEntity(table, entity):
     try:
         partitionKey = entity["PartitionKey"]
         rowkey = entity["RowKey"]
     except:
         raise Exception("PartitionKey and RowKey are required for entities")
-    tableserviceclient = TableServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-    tableclient = tableserviceclient.get_table_client(table)
+    tableclient = getTableClient(table)
     tableclient.upsert_entity(entity)
 
+def updateEntity(table, entity):
+    # merges into an existing entity, raises ResourceNotFoundError instead of creating it
+    try:
+        partitionKey = entity["PartitionKey"]
+        rowkey = entity["RowKey"]
+    except:
+        raise Exception("PartitionKey and RowKey are required for entities")
+    tableclient = getTableClient(table)
+    tableclient.update_entity(entity, mode=UpdateMode.MERGE)
+
 def deleteEntity(table, partitionkey, rowkey):
-    tableserviceclient = TableServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-    tableclient = tableserviceclient.get_table_client(table)
+    tableclient = getTableClient(table)
     try: 
         tableclient.delete_entity(partitionkey, rowkey)
     except:
         donothing = 1
 
+def getQueryExecutor():
+    with storageclientslock:
+        if "queryexecutor" not in storageclients:
+            storageclients["queryexecutor"] = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get("queryworkers", "8")), thread_name_prefix="query")
+        return storageclients["queryexecutor"]
+
+def submitEntities(table, operations):
+    # operations are (operation, entity) pairs as taken by TableClient.submit_transaction, for example ("upsert", entity) or ("delete", entity)
+    # they are grouped by PartitionKey and submitted up to 100 at a time, each chunk is atomic and chunks run concurrently on the shared query pool
+    partitions = OrderedDict()
+    for operation in operations:
+        partitions.setdefault(operation[1]["PartitionKey"], []).append(operation)
+    tableclient = getTableClient(table)
+    executor = getQueryExecutor()
+    futures = []
+    for partition in partitions.values():
+        for chunk in splitList(partition, 100):
+            futures.append(executor.submit(submitChunk, table, tableclient, chunk))
+    for future in futures:
+        future.result()
+
+def submitChunk(table, tableclient, chunk):
+    try:
+        tableclient.submit_transaction(chunk)
+    except TableTransactionError:
+        # a delete of a row that is already gone fails the whole chunk, so deletes fall back to one at a time like deleteEntity
+        if any(operation != "delete" for operation, entity in chunk):
+            raise
+        for operation, entity in chunk:
+            deleteEntity(table, entity["PartitionKey"], entity["RowKey"])
+
+def deleteEntities(table, entities):
+    submitEntities(table, [("delete", {"PartitionKey": e["PartitionKey"], "RowKey": e["RowKey"]}) for e in entities])
+
+def entityToDict(entity, properties, aliases):
+    currentity = {}
+    if (len(properties)>0 and "timestamp" in properties) or len(properties)==0:
+        currentity["timestamp"] = entity.metadata["timestamp"].isoformat()
+    for p in entity:
+        if (len(properties)>0 and p in properties) or len(properties)==0:
+            if "TablesEntityDatetime" in str(type(entity[p])):
+                currentity[p] = entity[p].isoformat()
+            else:
+                currentity[p] = entity[p]
+    for a in aliases:
+        currentity[aliases[a]] = currentity.pop(a)
+    return currentity
+
+def readEntities(table_client, filter, properties, aliases):
+    entities = []
+    for entity in table_client.query_entities(filter, select=properties):
+        entities.append(entityToDict(entity, properties or [], aliases))
+    return entities
+
 def queryEntities(table, filter, properties = None, aliases = {}, sortproperty = None, sortreverse=False, userid=None, connectionproperty=None):
-    table_service_client = TableServiceClient.from_connection_string(os.environ["storageaccount_connectionstring"])
-    table_client = table_service_client.get_table_client(table)
+    table_client = getTableClient(table)
 
     if (userid==None and connectionproperty != None) or (userid!=None and connectionproperty == None):
         raise Exception("userid and connectionproperty are both required if one is provided")
 
     # if connections are provided, then build successive calls with up to 10 checked in each
-    allentities = []
+    # batches run concurrently on the shared query pool and are appended in batch order
+    response = []
     if connectionproperty != None:
-        connections = [userid]
-        table_client_connections = table_service_client.get_table_client("connections")
-        for entity in table_client_connections.query_entities("PartitionKey eq '" + userid + "' and connectiontype eq 'connected'", select=["RowKey"]):
-            connections.append(entity["RowKey"])
+        connections = [userid] + getConnections(userid, True)
+        filters = []
         for connectionbatch in splitList(connections, 10):
             filteradd = ""
             if len(filter) != 0:
@@ -184,38 +599,161 @@ def queryEntities(table, filter, properties = None, aliases = {}, sortproperty =
                 first = False
                 filteradd += " " + connectionproperty + " eq '" + cb + "'"
             filteradd += ")"
-            allentities.append(table_client.query_entities(filter + filteradd, select=properties))
+            filters.append(filter + filteradd)
+        if len(filters) == 1:
+            response = readEntities(table_client, filters[0], properties, aliases)
+        else:
+            executor = getQueryExecutor()
+            futures = [executor.submit(readEntities, table_client, f, properties, aliases) for f in filters]
+            for future in futures:
+                response.extend(future.result())
     else:
-        allentities.append(table_client.query_entities(filter, select=properties))
+        response = readEntities(table_client, filter, properties, aliases)
 
-    if properties == None:
-        properties = []
-    response = []
-    for entities in allentities:
-        for entity in entities:
-            currentity = {}
-            if (len(properties)>0 and "timestamp" in properties) or len(properties)==0:
-                currentity["timestamp"] = entity.metadata["timestamp"].isoformat()
-            for p in entity:
-                if (len(properties)>0 and p in properties) or len(properties)==0:
-                    if "TablesEntityDatetime" in str(type(entity[p])):
-                        currentity[p] = entity[p].isoformat()
-                    else:
-                        currentity[p] = entity[p]
-            for a in aliases:
-                currentity[aliases[a]] = currentity.pop(a)
-            response.append(currentity)
-    if sortproperty != None and len(allentities)>0:
+    if sortproperty != None:
         try:
             response.sort(key=lambda s: s[sortproperty], reverse=sortreverse)
         except:
             raise Exception("Error in sorting, likely due to missing property in response or entity")
     return response
 
+def queryEntitiesByPartition(table, partitionkeys, properties, aliases = {}, sortproperty = None, sortreverse = False, filter = None):
+    # one query per 10 partitions using or'd PartitionKey filters, results are grouped by PartitionKey
+    # filter is and'd with the PartitionKey filters
+    grouped = {}
+    for pk in partitionkeys:
+        grouped[pk] = []
+    selectproperties = list(properties)
+    if "PartitionKey" not in selectproperties:
+        selectproperties.append("PartitionKey")
+    partitionalias = aliases.get("PartitionKey", "PartitionKey")
+    for partitionbatch in splitList(list(grouped.keys()), 10):
+        batchfilter = " or ".join(["PartitionKey eq '" + pk + "'" for pk in partitionbatch])
+        if filter != None:
+            batchfilter = "(" + batchfilter + ") and " + filter
+        for e in queryEntities(table, batchfilter, selectproperties, aliases, sortproperty, sortreverse):
+            if "PartitionKey" in properties:
+                pk = e[partitionalias]
+            else:
+                pk = e.pop(partitionalias)
+            grouped[pk].append(e)
+    return grouped
+
+def runCommit(steps, commit = None):
+    # steps are (action, rollback) pairs run concurrently, if any action fails the completed ones are rolled back
+    # commit runs last, once every step has succeeded, and all steps are rolled back if it fails
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(steps), 1)) as executor:
+        futures = [executor.submit(action) for action, rollback in steps]
+        concurrent.futures.wait(futures)
+    failures = [f.exception() for f in futures if f.exception() != None]
+    if len(failures) == 0 and commit != None:
+        try:
+            commit()
+        except Exception as ex:
+            failures.append(ex)
+    if len(failures) > 0:
+        for future, (action, rollback) in zip(futures, steps):
+            if future.exception() == None and rollback != None:
+                try:
+                    rollback()
+                except Exception as ex:
+                    logging.warning("rollback failed: " + str(ex))
+        raise failures[0]
+
 def splitList(list, size):
     for i in range(0, len(list), size):
         yield list[i:i + size]
 
+def getCache(name):
+    with cacheslock:
+        if name not in caches:
+            caches[name] = {"entries": OrderedDict(), "hits": 0, "misses": 0, "bytes": 0, "lock": threading.Lock()}
+        return caches[name]
+
+def cachePop(cache, key):
+    # callers hold the cache lock
+    entry = cache["entries"].pop(key, None)
+    if entry != None:
+        cache["bytes"] -= entry["size"]
+    return entry
+
+def cacheGet(name, key):
+    cache = getCache(name)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry != None and entry["expires"] > time.time():
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return {"status": True, "value": entry["value"]}
+        if entry != None:
+            cachePop(cache, key)
+        cache["misses"] += 1
+        return {"status": False, "value": None}
+
+def cacheSet(name, key, value, ttl, maxentries = 10000, size = 0, maxbytes = None):
+    # size is what the entry counts against maxbytes, least recently used entries are evicted past either limit
+    cache = getCache(name)
+    with cache["lock"]:
+        cachePop(cache, key)
+        cache["entries"][key] = {"value": value, "expires": time.time() + ttl, "size": size}
+        cache["bytes"] += size
+        while len(cache["entries"]) > maxentries or (maxbytes != None and cache["bytes"] > maxbytes):
+            cachePop(cache, next(iter(cache["entries"])))
+
+def cacheInvalidate(name, keys = None):
+    cache = getCache(name)
+    with cache["lock"]:
+        if keys == None:
+            cache["entries"].clear()
+            cache["bytes"] = 0
+        else:
+            for k in keys:
+                cachePop(cache, k)
+
+def cacheInvalidateMatching(name, match):
+    cache = getCache(name)
+    with cache["lock"]:
+        for k in [k for k, v in cache["entries"].items() if match(v["value"])]:
+            cachePop(cache, k)
+
+def cacheStatistics():
+    statistics = {}
+    with cacheslock:
+        names = list(caches.keys())
+    for name in names:
+        cache = getCache(name)
+        with cache["lock"]:
+            requests = cache["hits"] + cache["misses"]
+            statistics[name] = {"hits": cache["hits"], "misses": cache["misses"], "hitrate": round(cache["hits"] / requests, 4) if requests > 0 else None, "entries": len(cache["entries"]), "bytes": cache["bytes"]}
+    return statistics
+
+def getConnections(userid, cached = False):
+    # connected userids for a user, with cached they come from a per worker cache for connectioncachettl
+    # invalidation only reaches this worker so the cache can lag a change by connectioncachettl
+    # feed writes read the table, a stale list there would lose feed rows for good where a stale read only costs a page view
+    if cached:
+        cg = cacheGet("connections", userid)
+        if cg["status"]:
+            return cg["value"]
+        with cacheslock:
+            version = connectionversions.get(userid, 0)
+    connections = []
+    for entity in getTableClient("connections").query_entities("PartitionKey eq '" + userid + "' and connectiontype eq 'connected'", select=["RowKey"]):
+        connections.append(entity["RowKey"])
+    if cached:
+        # a list read before an invalidation is not written back over it
+        with cacheslock:
+            current = connectionversions.get(userid, 0) == version
+        if current:
+            cacheSet("connections", userid, connections, int(os.environ.get("connectioncachettl", "30")))
+    return connections
+
+def invalidateConnections(userids):
+    with cacheslock:
+        for userid in userids:
+            connectionversions[userid] = connectionversions.get(userid, 0) + 1
+    cacheInvalidate("connections", userids)
+
 def incrementDecrement(table, partitionkey, rowkey, property, value, integer):
     entity = queryEntities(table, "PartitionKey eq '" + partitionkey + "' and RowKey eq '" + rowkey + "'", [property])
     if len(entity) == 0:
@@ -248,12 +786,25 @@ def tsUnixToIso(ts):
 def tsIsoToUnix(ts):
     return parser.isoparse(ts).timestamp()
 
+def getValidations():
+    # the whole validate table is small, so it is loaded once per worker and refreshed after validatecachettl
+    cg = cacheGet("validate", "catalogue")
+    if cg["status"]:
+        return cg["value"]
+    catalogue = {"values": {}, "types": {}}
+    for entity in getTableClient("validate").list_entities(select=["PartitionKey", "RowKey", "label", "sort"]):
+        e = entityToDict(entity, ["PartitionKey", "RowKey", "label", "sort"], {})
+        catalogue["values"][(e["PartitionKey"], e["RowKey"])] = e
+        catalogue["types"].setdefault(e["PartitionKey"], []).append(e)
+    cacheSet("validate", "catalogue", catalogue, int(os.environ.get("validatecachettl", "600")))
+    return catalogue
+
 def validateData(validationtype, value):
-    qe = queryEntities("validate","PartitionKey eq '" + validationtype + "' and RowKey eq '" + value + "'")
-    if len(qe) == 0:
+    e = getValidations()["values"].get((validationtype, value))
+    if e == None:
         return {"status": False, "label": "NoLabel"}
     else:
-        return {"status": True, "label": qe[0]["label"]}
+        return {"status": True, "label": e["label"]}
 
 def authorizer(req):
 
@@ -265,7 +816,12 @@ def authorizer(req):
     timezone = 'US/Eastern'
 
     try:
-        data = jwt.decode(req.headers["Authorization"].replace('Bearer ',''), os.environ['secret'], algorithms="HS256")
+        token = req.headers["Authorization"].replace('Bearer ','')
+        # a token seen before skips the decode and users lookup until it expires or authcachettl lapses
+        cg = cacheGet("authorizer", token)
+        if cg["status"]:
+            return dict(cg["value"])
+        data = jwt.decode(token, os.environ['secret'], algorithms="HS256")
         qe = queryEntities("users", "PartitionKey eq '" + data["sub"] + "' and RowKey eq 'account'", ["PartitionKey","unitsystem", "timezone"], {"PartitionKey":"userid"})[0]
         if len(qe) > 0:
             authorized = True
@@ -274,10 +830,17 @@ def authorizer(req):
             timezone = qe["timezone"]
         if data["exp"] < int(time.time()):
             authorized = False
+        if authorized:
+            ttl = min(int(os.environ.get("authcachettl", "60")), data["exp"] - int(time.time()))
+            if ttl > 0:
+                cacheSet("authorizer", token, {"authorized": authorized, "userid": userid, "unitsystem": unitsystem, "timezone": timezone}, ttl, int(os.environ.get("authcachesize", "1000")))
     except:
         none = 1
     return {"authorized": authorized, "userid": userid, "unitsystem": unitsystem, "timezone": timezone}
 
+def invalidateAuthorizer(userid):
+    cacheInvalidateMatching("authorizer", lambda v: v["userid"] == userid)
+
 def checkJsonProperties(json, properties):
     matched = []
     missing = []
@@ -381,13 +944,376 @@ def launderTimezone(timestamp, timezone):
     formattime = tztime.strftime("%B %d at %I:%M %p")
     return formattime
 
-def resizeImage(img, size, quality):
+def getTileCacheIndex():
+    # lru index of the on-disk tile cache, rebuilt from file modification times when a worker starts
+    with storageclientslock:
+        if "tilecache" not in storageclients:
+            directory = os.environ.get("tilecachedir", os.path.join(tempfile.gettempdir(), "outsidely-tiles"))
+            os.makedirs(directory, exist_ok=True)
+            files = []
+            for root, dirs, names in os.walk(directory):
+                for n in names:
+                    path = os.path.join(root, n)
+                    files.append((os.path.getmtime(path), path, os.path.getsize(path)))
+            entries = OrderedDict()
+            for mtime, path, size in sorted(files):
+                entries[path] = size
+            storageclients["tilecache"] = {"directory": directory, "entries": entries, "size": sum(entries.values()), "lock": threading.Lock()}
+        return storageclients["tilecache"]
+
+def readTileCache(key):
+    tilecache = getTileCacheIndex()
+    path = os.path.join(tilecache["directory"], key + ".png")
+    with tilecache["lock"]:
+        if path not in tilecache["entries"]:
+            return None
+        tilecache["entries"].move_to_end(path)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        return None
+
+def writeTileCache(key, data):
+    tilecache = getTileCacheIndex()
+    path = os.path.join(tilecache["directory"], key + ".png")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    budget = int(os.environ.get("tilecachemb", "200")) * 1024 * 1024
+    with tilecache["lock"]:
+        tilecache["size"] += len(data) - tilecache["entries"].pop(path, 0)
+        tilecache["entries"][path] = len(data)
+        while tilecache["size"] > budget and len(tilecache["entries"]) > 1:
+            evictpath, evictsize = tilecache["entries"].popitem(last=False)
+            tilecache["size"] -= evictsize
+            try:
+                os.remove(evictpath)
+            except OSError:
+                pass
+
+def blankTile():
     from PIL import Image
-    newimg = Image.open(img)
-    newimg.thumbnail(size)
-    outimg = BytesIO()
-    newimg.save(outimg, optimize=True, quality=quality, format="JPEG")
-    return outimg.getvalue()
+    with storageclientslock:
+        if "blanktile" not in storageclients:
+            tile = BytesIO()
+            Image.new("RGBA", (256, 256), (0, 0, 0, 0)).save(tile, format="PNG")
+            storageclients["blanktile"] = tile.getvalue()
+        return storageclients["blanktile"]
+
+def getTile(key, **kwargs):
+    # staticmap tile source, key is z/x/y
+    # tiles come from the disk cache, then the optional tilecachecontainer, then the network unless tilemode is offline
+    # anything that cannot be found is drawn as a blank tile so previews never fail on tiles
+    data = readTileCache(key)
+    if data != None:
+        return 200, data
+    container = os.environ.get("tilecachecontainer")
+    if container != None:
+        try:
+            data = getContainerClient(container).get_blob_client(key + ".png").download_blob().readall()
+            writeTileCache(key, data)
+            return 200, data
+        except:
+            pass
+    if os.environ.get("tilemode", "online") == "offline":
+        return 200, blankTile()
+    try:
+        import requests
+        z, x, y = key.split("/")
+        response = requests.get(os.environ.get("tileurl", "http://a.tile.osm.org/{z}/{x}/{y}.png").format(z=z, x=x, y=y), timeout=float(os.environ.get("tiletimeout", "5")), headers={"User-Agent": "outsidely-geo"})
+        if response.status_code != 200:
+            raise Exception("tile request failed with status " + str(response.status_code))
+        data = response.content
+    except Exception as ex:
+        logging.warning("could not fetch tile " + key + ": " + str(ex))
+        return 200, blankTile()
+    writeTileCache(key, data)
+    if container != None:
+        try:
+            getContainerClient(container).get_blob_client(key + ".png").upload_blob(data, overwrite=True)
+        except:
+            pass
+    return 200, data
+
+def renderPreview(coordinates):
+    from staticmap import StaticMap, Line
+    m = StaticMap(300, 300, padding_x=10, padding_y=10, url_template="{z}/{x}/{y}", background_color="#f2efe9")
+    m.get = getTile
+    m.add_line(Line(coordinates, 'red', 3))
+    preview = BytesIO()
+    image = m.render()
+    image.save(preview, optimize=True, quality=100, format="JPEG")
+    return preview.getvalue()
+
+def createActivityArtifacts(activityid):
+    # builds geojson.json and preview.jpg from a stored activitydata.json
+    import geopandas
+    import numpy
+    from shapely.geometry import LineString
+
+    gb = getBlob(activityid + "/activitydata.json")
+    if not gb["status"]:
+        raise Exception("activitydata not found for " + activityid)
+    columns = activityDataColumns(json.loads(gb["data"])["data"])
+
+    # create clean track file
+    points = numpy.column_stack((columns["longitude"], columns["latitude"]))
+    route = geopandas.GeoSeries([LineString(points)])
+    routejson = json.loads(route.to_json())
+
+    # create preview
+    routejsonsimplified = json.loads(route.simplify(.0001).to_json())
+    preview = renderPreview(routejsonsimplified["features"][0]["geometry"]["coordinates"])
+
+    steps = [
+        (functools.partial(saveBlob, json.dumps(routejson).encode(), activityid + "/geojson.json", "application/json", True), None),
+        (functools.partial(saveBlob, preview, activityid + "/preview.jpg", "image/jpeg"), None)
+    ]
+
+    # pre-simplified levels of detail served by data/geojson for a zoom or tolerance
+    for tolerance in trackLevels():
+        if tolerance == .0001:
+            levelbytes = json.dumps(routejsonsimplified).encode()
+        else:
+            levelbytes = route.simplify(tolerance).to_json().encode()
+        steps.append((functools.partial(saveBlob, levelbytes, trackLevelName(activityid, tolerance), "application/json", True), None))
+    runCommit(steps)
+    cacheInvalidate("blobs", [activityid + "/preview.jpg"])
+
+def trackLevels():
+    return sorted([float(t) for t in os.environ.get("tracklevels", "0.00001,0.0001,0.001").split(",") if len(t.strip()) > 0])
+
+def trackLevelName(activityid, tolerance):
+    return activityid + "/geojson_" + format(tolerance, "f").rstrip("0") + ".json"
+
+def getTrackBlob(activityid, zoom = None, tolerance = None, decompress = True, conditions = None, byterange = None, maxsize = None):
+    # smallest stored level whose tolerance is within the requested one, falling back to finer levels and the full track
+    if zoom != None:
+        # half a 256px web mercator tile pixel in degrees
+        tolerance = 360 / (256 * 2 ** float(zoom)) / 2
+    if tolerance != None:
+        for level in reversed([t for t in trackLevels() if t <= float(tolerance)]):
+            gb = getBlob(trackLevelName(activityid, level), decompress, conditions, byterange, maxsize)
+            if gb["status"]:
+                return gb
+    return getBlob(activityid + "/geojson.json", decompress, conditions, byterange, maxsize)
+
+def encodePolyline(coordinates, precision = 5):
+    # google encoded polyline of [longitude, latitude] pairs
+    factor = 10 ** precision
+    encoded = []
+    priorlatitude = 0
+    priorlongitude = 0
+    for longitude, latitude in [(c[0], c[1]) for c in coordinates]:
+        latitude = int(round(latitude * factor))
+        longitude = int(round(longitude * factor))
+        for delta in [latitude - priorlatitude, longitude - priorlongitude]:
+            value = ~(delta << 1) if delta < 0 else (delta << 1)
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        priorlatitude = latitude
+        priorlongitude = longitude
+    return "".join(encoded)
+
+def deltaEncode(values, scale):
+    # values are scaled to integers and stored as differences from the previous present value, missing values are null
+    encoded = []
+    prior = 0
+    for v in values:
+        if v == None or math.isnan(v):
+            encoded.append(None)
+        else:
+            current = int(round(v * scale))
+            encoded.append(current - prior)
+            prior = current
+    return encoded
+
+def encodeActivityColumns(activitydata):
+    data = activitydata["data"]
+    scales = {"time": 1000, "longitude": 10000000, "latitude": 10000000, "elevation": 10, "heartrate": 1, "cadence": 1, "power": 1}
+    compact = {"version": activitydata.get("version", 1), "encoding": "delta", "count": len(data), "scale": {}}
+    if len(data) > 0:
+        compact["starttime"] = data[0]["timestamp"]
+        starttime = parseIsoTimestamp(data[0]["timestamp"]).timestamp()
+        compact["scale"]["time"] = scales["time"]
+        compact["time"] = deltaEncode([parseIsoTimestamp(d["timestamp"]).timestamp() - starttime for d in data], scales["time"])
+    for name in ["longitude", "latitude", "elevation", "heartrate", "cadence", "power"]:
+        if any(name in d for d in data):
+            compact["scale"][name] = scales[name]
+            compact[name] = deltaEncode([d.get(name) for d in data], scales[name])
+    return compact
+
+def acceptsEncoding(req, encoding):
+    # an exact coding takes precedence over *, a q value of 0 refuses it, tokens with a malformed q value are ignored
+    weights = {}
+    for token in req.headers.get("Accept-Encoding", "").split(","):
+        parts = [p.strip() for p in token.split(";")]
+        weight = 1.0
+        try:
+            for p in parts[1:]:
+                if p.lower().startswith("q="):
+                    weight = float(p[2:])
+        except ValueError:
+            continue
+        weights[parts[0].lower()] = weight
+    weight = weights.get(encoding, weights.get("*", 0))
+    return weight > 0
+
+def requestConditions(req, representation):
+    # blob conditions from If-None-Match or If-Modified-Since, etags only apply to the same representation
+    import email.utils
+    conditions = {"etag": None, "modifiedsince": None}
+    for tag in req.headers.get("If-None-Match", "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if len(tag) == 0:
+            continue
+        base, separator, suffix = tag.partition("-")
+        if suffix == representation:
+            conditions["etag"] = '"' + base + '"'
+            return conditions
+    if len(req.headers.get("If-None-Match", "")) == 0 and len(req.headers.get("If-Modified-Since", "")) > 0:
+        try:
+            conditions["modifiedsince"] = email.utils.parsedate_to_datetime(req.headers.get("If-Modified-Since"))
+        except (TypeError, ValueError):
+            pass
+    return conditions
+
+def cacheHeaders(gb, representation):
+    # blobs served by data/ are written once, so they get a weak etag per representation and a long lived cache-control
+    # private by default since data/ is authorized per user and shared caches must not hand it to others
+    import email.utils
+    headers = {"Cache-Control": os.environ.get("datacachecontrol", "private, max-age=31536000, immutable"), "Vary": "Accept, Accept-Encoding"}
+    if gb.get("etag") != None:
+        tag = gb["etag"].strip('"')
+        if len(representation) > 0:
+            tag += "-" + representation
+        headers["ETag"] = 'W/"' + tag + '"'
+    if gb.get("lastmodified") != None:
+        headers["Last-Modified"] = email.utils.format_datetime(gb["lastmodified"].astimezone(datetime.timezone.utc), usegmt=True)
+    return headers
+
+def encodedHttpResponse(req, gb, headers = None, acceptranges = False):
+    # passes stored encodings through when the client accepts them, otherwise decodes, and gzips uncompressed json
+    # with acceptranges, ranges are advertised only when the body sent is the stored bytes, since ranges are served over those
+    data = gb["data"]
+    contentencoding = gb.get("contentencoding")
+    stored = True
+    if headers == None:
+        headers = {"Vary": "Accept, Accept-Encoding"}
+    if contentencoding != None and not acceptsEncoding(req, contentencoding):
+        data = decodeContent(data, contentencoding)
+        contentencoding = None
+        stored = False
+    if contentencoding == None and len(data) > 1024 and str(gb["contenttype"]).startswith("application/") and acceptsEncoding(req, "gzip"):
+        data = encodeContent(data, "gzip")
+        contentencoding = "gzip"
+        stored = False
+    if contentencoding != None:
+        headers["Content-Encoding"] = contentencoding
+    if acceptranges and stored:
+        headers["Accept-Ranges"] = "bytes"
+    return func.HttpResponse(data, status_code=200, mimetype=gb["contenttype"], headers=headers)
+
+def mediaSizes():
+    # name, longest side and quality of each media derivative, largest first
+    sizes = []
+    for size in os.environ.get("mediasizes", "full:1200:95,preview:300:80").split(","):
+        name, pixels, quality = size.strip().split(":")
+        sizes.append((name, int(pixels), int(quality)))
+    return sorted(sizes, key=lambda s: s[1], reverse=True)
+
+def mediaFormats():
+    # optional extra encodings of each derivative next to the jpeg, skipped when pillow was built without them
+    from PIL import features
+    formats = []
+    for format in os.environ.get("mediaformats", "").split(","):
+        format = format.strip().lower()
+        if format in ["webp", "avif"] and features.check(format):
+            formats.append(format)
+    return formats
+
+def storedMediaFormats(activityid, mediaid):
+    # extra encodings mediaderivatives stored for a media object, kept on its entity so data/ does not look for missing blobs
+    # derivatives do not change once ready, so the answer is cached for as long as the blobs themselves
+    cg = cacheGet("mediaformats", activityid + "/" + mediaid)
+    if cg["status"]:
+        return cg["value"]
+    qe = queryEntities("media", "PartitionKey eq '" + activityid + "' and RowKey eq '" + mediaid + "'", ["mediastatus", "mediaformats"])
+    if len(qe) != 1:
+        return []
+    formats = [f for f in qe[0].get("mediaformats", "").split(",") if f != ""]
+    if qe[0].get("mediastatus") == "ready":
+        cacheSet("mediaformats", activityid + "/" + mediaid, formats, int(os.environ.get("blobcachettl", "3600")))
+    return formats
+
+def createMediaEntities(activityid, entities):
+    # sort orders continue from a ~sort counter row in the media partition, in the order given
+    # the counter is created or updated conditioned on its etag in the same transaction as the entities,
+    # so concurrent uploads to an activity cannot take the same sort orders and are retried when they collide
+    tableclient = getTableClient("media")
+    for attempt in range(int(os.environ.get("mediasortattempts", "10"))):
+        counter = list(tableclient.query_entities("PartitionKey eq '" + activityid + "' and RowKey eq '~sort'"))
+        if len(counter) == 0:
+            # partitions from before the counter continue from their highest sort
+            sort = 0
+            for e in queryEntities("media", "PartitionKey eq '" + activityid + "' and RowKey lt '~'", ["sort"]):
+                sort = max(sort, int(e.get("sort", 0)))
+        else:
+            sort = int(counter[0].get("sort", 0))
+        operations = []
+        for entity in entities:
+            sort += 1
+            entity["sort"] = sort
+            operations.append(("create", entity))
+        if len(counter) == 0:
+            operations.append(("create", {"PartitionKey": activityid, "RowKey": "~sort", "sort": sort}))
+        else:
+            operations.append(("update", {"PartitionKey": activityid, "RowKey": "~sort", "sort": sort}, {"mode": UpdateMode.MERGE, "etag": counter[0].metadata["etag"], "match_condition": MatchConditions.IfNotModified}))
+        try:
+            tableclient.submit_transaction(operations)
+            return
+        except TableTransactionError as ex:
+            if ex.status_code not in [409, 412]:
+                raise
+    raise Exception("media sort orders for " + activityid + " changed too often to reserve")
+
+def getMediaSemaphore():
+    # bounds image decoding per worker so a burst of uploads leaves threads for requests
+    with storageclientslock:
+        if "mediasemaphore" not in storageclients:
+            storageclients["mediasemaphore"] = threading.BoundedSemaphore(int(os.environ.get("mediaworkers", "2")))
+        return storageclients["mediasemaphore"]
+
+def processImage(upload):
+    # decodes the upload once, jpegs at a reduced scale with draft, and thumbnails each size from the previous larger one
+    # returns {name: [(data, contenttype, suffix)]} with the jpeg first and a suffix per extra format
+    from PIL import Image
+    sizes = mediaSizes()
+    img = Image.open(BytesIO(upload))
+    # twice the largest size, the same reducing gap thumbnail uses, keeps the downscale quality
+    img.draft("RGB", (sizes[0][1] * 2, sizes[0][1] * 2))
+    if img.mode not in ["RGB", "L"]:
+        img = img.convert("RGB")
+    formats = mediaFormats()
+    derivatives = {}
+    for name, pixels, quality in sizes:
+        img.thumbnail((pixels, pixels))
+        outimg = BytesIO()
+        img.save(outimg, optimize=True, quality=quality, format="JPEG")
+        derivatives[name] = [(outimg.getvalue(), "image/jpeg", "")]
+        for format in formats:
+            outimg = BytesIO()
+            img.save(outimg, quality=quality, format=format.upper())
+            derivatives[name].append((outimg.getvalue(), "image/" + format, "_" + format))
+    return derivatives
 
 def useridExists(userid):
     if len(queryEntities("users", "PartitionKey eq '" + userid + "' and RowKey eq 'account'"))>0:
@@ -418,6 +1344,258 @@ def createNotification(userid, message, options = None, properties = None):
         except:
             pass
 
+def activityTotals(activity = None):
+    totals = {"count": 0, "ascent": float(0), "descent": float(0), "distance": float(0), "time": 0}
+    if activity != None:
+        totals["count"] = 1
+        for k in ["ascent", "descent", "distance", "time"]:
+            if (activity.get(k) or 0) > 0:
+                totals[k] += activity[k]
+    return totals
+
+def adjustStatistics(userid, activity, sign, includeall = True, rebuild = False):
+    # running totals per user ("all") and per activitytype, only kept once rebuildStatistics has created them
+    # with rebuild the totals are built instead when they do not exist yet, for callers that make a single adjustment after the activity is written
+    # rows are changed in one transaction conditioned on the etags read, and read again when another writer got there first
+    delta = activityTotals(activity)
+    rowkeys = ["activitytype_" + str(activity.get("activitytype"))]
+    if includeall:
+        rowkeys.append("all")
+    tableclient = getTableClient("statistics")
+    for attempt in range(int(os.environ.get("statisticsattempts", "10"))):
+        rows = {}
+        for e in tableclient.query_entities("PartitionKey eq '" + userid + "'"):
+            rows[e["RowKey"]] = e
+        if "all" not in rows:
+            if rebuild:
+                rebuildStatistics(userid)
+            return
+        operations = []
+        for rowkey in rowkeys:
+            row = rows.get(rowkey)
+            entity = {"PartitionKey": userid, "RowKey": rowkey}
+            for k in delta.keys():
+                entity[k] = max((row or {}).get(k, 0) + sign * delta[k], 0)
+            if row == None:
+                operations.append(("create", entity))
+            else:
+                operations.append(("update", entity, {"mode": UpdateMode.MERGE, "etag": row.metadata["etag"], "match_condition": MatchConditions.IfNotModified}))
+        try:
+            tableclient.submit_transaction(operations)
+            return
+        except TableTransactionError as ex:
+            if ex.status_code not in [409, 412]:
+                raise
+    raise Exception("statistics for " + userid + " changed too often to update")
+
+def computeStatistics(userid):
+    totals = {"all": activityTotals()}
+    for e in queryEntities("activities", "PartitionKey eq '" + userid + "'", ["activitytype", "ascent", "descent", "distance", "time"]):
+        delta = activityTotals(e)
+        rowkey = "activitytype_" + str(e.get("activitytype"))
+        if rowkey not in totals:
+            totals[rowkey] = activityTotals()
+        for k in delta.keys():
+            totals["all"][k] += delta[k]
+            totals[rowkey][k] += delta[k]
+    return totals
+
+def rebuildStatistics(userid):
+    totals = computeStatistics(userid)
+    for e in queryEntities("statistics", "PartitionKey eq '" + userid + "'", ["RowKey"]):
+        if e["RowKey"] not in totals:
+            deleteEntity("statistics", userid, e["RowKey"])
+    for rowkey in totals.keys():
+        entity = {"PartitionKey": userid, "RowKey": rowkey}
+        entity.update(totals[rowkey])
+        upsertEntity("statistics", entity)
+    return totals
+
+def encodeCursor(cursor):
+    # cursors are opaque to clients, url safe base64 of compact json
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decodeCursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except:
+        raise Exception("invalid cursor")
+
+def feedRowKey(createtime, activityid):
+    # inverted milliseconds so a feed partition reads newest first
+    return str(10**13 - int(createtime * 1000)).zfill(13) + "_" + activityid
+
+def feedTargets(userid, visibilitytype = None):
+    # feeds an activity is written to, private activities only reach their owner
+    if visibilitytype == "private":
+        return [userid]
+    return [userid] + getConnections(userid)
+
+def writeFeedEntries(ownerids, userid, activityid, feedkey):
+    executor = getQueryExecutor()
+    futures = [executor.submit(upsertEntity, "feeds", {"PartitionKey": o, "RowKey": feedkey, "userid": userid, "activityid": activityid}) for o in ownerids]
+    for future in futures:
+        future.result()
+
+def deleteFeedEntries(ownerids, feedkey):
+    executor = getQueryExecutor()
+    futures = [executor.submit(deleteEntity, "feeds", o, feedkey) for o in ownerids]
+    for future in futures:
+        future.result()
+
+def activityFeedKey(activity):
+    # activities from before the feeds table have no feedkey, one is derived from their starttime
+    # it is not written back, since that would move the activity's Timestamp that windows and the edit check rely on
+    if activity.get("feedkey") != None:
+        return activity["feedkey"]
+    return feedRowKey(tsIsoToUnix(activity["starttime"]), activity["activityid"])
+
+def backfillFeed(ownerid, authorid, since):
+    # copies an author's activities with a Timestamp from since into a feed, used when users connect and when a feed is first built
+    filter = "PartitionKey eq '" + authorid + "' and Timestamp ge datetime'" + tsUnixToIso(since) + "'"
+    # every entry is in the owner's partition, so they are written in transactions of up to 100
+    operations = []
+    for a in queryEntities("activities", filter, ["RowKey", "starttime", "visibilitytype", "feedkey"], {"RowKey": "activityid"}):
+        if a.get("visibilitytype", "") != "private" or ownerid == authorid:
+            operations.append(("upsert", {"PartitionKey": ownerid, "RowKey": activityFeedKey(a), "userid": authorid, "activityid": a["activityid"]}))
+    submitEntities("feeds", operations)
+
+def removeFeedAuthor(ownerid, authorid):
+    deleteEntities("feeds", queryEntities("feeds", "PartitionKey eq '" + ownerid + "' and userid eq '" + authorid + "'", ["PartitionKey", "RowKey"]))
+
+def feedBuilt(userid):
+    # a feed partition is built from activities on first use and marked with a ~built row that sorts after every entry
+    # returns since, kept on the ~built row, the feed holds activities with a Timestamp from since and older ones are paged by window
+    cg = cacheGet("feeds", userid)
+    if cg["status"]:
+        return cg["value"]
+    qe = queryEntities("feeds", "PartitionKey eq '" + userid + "' and RowKey eq '~built'")
+    if len(qe) == 0:
+        since = int(time.time()) - int(os.environ.get("feedlookback", str(86400*365)))
+        for authorid in [userid] + getConnections(userid):
+            backfillFeed(userid, authorid, since)
+        upsertEntity("feeds", {"PartitionKey": userid, "RowKey": "~built", "since": since})
+    elif qe[0].get("since") == None:
+        # rows from before since was kept were built from feedlookback when they were written
+        since = int(tsIsoToUnix(qe[0]["timestamp"])) - int(os.environ.get("feedlookback", str(86400*365)))
+    else:
+        since = int(qe[0]["since"])
+    cacheSet("feeds", userid, since, int(os.environ.get("feedbuiltcachettl", "3600")))
+    return since
+
+def readActivities(keys):
+    # full activity entities for (userid, activityid) pairs, batched like queryEntitiesByPartition and joined back by key
+    found = {}
+    executor = getQueryExecutor()
+    futures = []
+    for batch in splitList(keys, 10):
+        filter = " or ".join(["(PartitionKey eq '" + userid + "' and RowKey eq '" + activityid + "')" for userid, activityid in batch])
+        futures.append(executor.submit(queryEntities, "activities", filter, None, {"PartitionKey": "userid", "RowKey": "activityid"}))
+    for future in futures:
+        for a in future.result():
+            found[(a["userid"], a["activityid"])] = a
+    return found
+
+def activityFeedPage(userid, feeduserid, pagesize, cursor = None, include = None):
+    # newest first page of a user's feeds partition, service pages are followed by continuation token until the page is full
+    # the cursor is the last feed RowKey read, so the next page can start part way through a service page
+    # entries from users no longer connected or for deleted activities are skipped
+    feedBuilt(userid)
+    filter = "PartitionKey eq '" + userid + "' and RowKey lt '~'"
+    if cursor != None and cursor.get("rowkey") != None:
+        filter += " and RowKey gt '" + cursor["rowkey"] + "'"
+    if feeduserid != None:
+        filter += " and userid eq '" + feeduserid + "'"
+    authors = set([userid] + getConnections(userid, True))
+    page = []
+    for feedpage in getTableClient("feeds").query_entities(filter, select=["RowKey", "userid", "activityid"], results_per_page=pagesize).by_page():
+        entries = [(e["RowKey"], e["userid"], e["activityid"]) for e in feedpage]
+        found = readActivities([(u, a) for rowkey, u, a in entries if u in authors])
+        for rowkey, u, a in entries:
+            activity = found.get((u, a))
+            if activity != None and (include == None or include(activity)):
+                page.append(activity)
+                if len(page) == pagesize:
+                    return page, {"rowkey": rowkey}
+    return page, None
+
+def deletionStages(jobtype):
+    # cascade deletion stages in order, each can be run again after an interruption
+    # a user's activities are snapshotted first, then taken out of view before anything they point to is deleted
+    if jobtype == "activity":
+        return ["blobs", "activitychildren"]
+    return ["snapshot", "connections", "feed", "activities", "blobs", "activitychildren", "userpartitions", "cleanup"]
+
+def deletionTargetExists(job):
+    # jobs are created before the account or activity row is deleted, so they wait until that delete has happened
+    if job["jobtype"] == "activity":
+        return len(queryEntities("activities", "PartitionKey eq '" + job["PartitionKey"] + "' and RowKey eq '" + job["activityid"] + "'", ["RowKey"])) > 0
+    return useridExists(job["PartitionKey"])
+
+def snapshotActivities(job, activityids):
+    submitEntities("deletejobitems", [("upsert", {"PartitionKey": job["RowKey"], "RowKey": a}) for a in activityids])
+
+def deletionActivities(job):
+    # activities a job works through, the snapshot taken by a user job or the single activity
+    if job["jobtype"] == "activity":
+        return [job["activityid"]]
+    return sorted([e["RowKey"] for e in queryEntities("deletejobitems", "PartitionKey eq '" + job["RowKey"] + "'", ["RowKey"])])
+
+def runDeletionStage(job, deadline):
+    # runs job["stage"] from job["checkpoint"], returns False when deadline passes before the stage is done
+    userid = job["PartitionKey"]
+    stage = job["stage"]
+    if stage == "snapshot":
+        snapshotActivities(job, [e["RowKey"] for e in queryEntities("activities", "PartitionKey eq '" + userid + "'", ["RowKey"])])
+    elif stage in ["blobs", "activitychildren"]:
+        # activities are worked through in order and the last one finished is the checkpoint
+        for activityid in deletionActivities(job):
+            if activityid <= job.get("checkpoint", ""):
+                continue
+            if time.time() > deadline:
+                return False
+            if stage == "blobs":
+                names = [b.name for b in listBlobs(activityid + "/")]
+                deleteBlobs(names)
+                job["deletedblobs"] = job.get("deletedblobs", 0) + len(names)
+            else:
+                # does not delete props or comments made by the user on other activities
+                for table in ["props", "comments", "media"]:
+                    entities = queryEntities(table, "PartitionKey eq '" + activityid + "'", ["PartitionKey", "RowKey"])
+                    deleteEntities(table, entities)
+                    job["deletedentities"] = job.get("deletedentities", 0) + len(entities)
+            job["checkpoint"] = activityid
+            upsertEntity("deletejobs", job)
+    elif stage == "activities":
+        # activities written after the snapshot by a worker that had not yet seen the account go are added to it
+        snapshotActivities(job, [e["RowKey"] for e in queryEntities("activities", "PartitionKey eq '" + userid + "'", ["RowKey"])])
+        entities = [{"PartitionKey": userid, "RowKey": a} for a in deletionActivities(job)]
+        deleteEntities("activities", entities)
+        job["deletedentities"] = job.get("deletedentities", 0) + len(entities)
+    elif stage == "connections":
+        # connections, and the user's entries in their feeds
+        for e in queryEntities("connections", "PartitionKey eq '" + userid + "'", ["PartitionKey", "RowKey"]):
+            deleteEntities("connections", [e, {"PartitionKey": e["RowKey"], "RowKey": e["PartitionKey"]}])
+            invalidateConnections([e["RowKey"]])
+            removeFeedAuthor(e["RowKey"], userid)
+            job["deletedentities"] = job.get("deletedentities", 0) + 2
+        invalidateConnections([userid])
+    elif stage == "feed":
+        entities = queryEntities("feeds", "PartitionKey eq '" + userid + "'", ["PartitionKey", "RowKey"])
+        deleteEntities("feeds", entities)
+        cacheInvalidate("feeds", [userid])
+        job["deletedentities"] = job.get("deletedentities", 0) + len(entities)
+    elif stage == "userpartitions":
+        for table in ["gear", "statistics", "notifications", "deletions"]:
+            entities = queryEntities(table, "PartitionKey eq '" + userid + "'", ["PartitionKey", "RowKey", "userid"])
+            # the account deletion row is kept, newuser relies on it to refuse the userid again
+            entities = [{"PartitionKey": e["PartitionKey"], "RowKey": e["RowKey"]} for e in entities if table != "deletions" or e.get("userid") == None]
+            deleteEntities(table, entities)
+            job["deletedentities"] = job.get("deletedentities", 0) + len(entities)
+    elif stage == "cleanup":
+        deleteEntities("deletejobitems", queryEntities("deletejobitems", "PartitionKey eq '" + job["RowKey"] + "'", ["PartitionKey", "RowKey"]))
+    return True
+
 def escapeHtml(obj, properties):
     for p in properties:
         if p in obj:
@@ -425,7 +1603,8 @@ def escapeHtml(obj, properties):
     return obj
 
 @app.route(route="statistics/{userid}", methods=[func.HttpMethod.GET])
-def statistics(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="statisticsqueue", queue_name="statistics", connection="storageaccount_connectionstring")
+def statistics(req: func.HttpRequest, statisticsqueue: func.Out[str]) -> func.HttpResponse:
     logging.info('called statistics')
     try:
 
@@ -433,24 +1612,26 @@ def statistics(req: func.HttpRequest) -> func.HttpResponse:
         if not auth["authorized"]:
             return createJsonHttpResponse(401, "unauthorized")
         
-        qe = queryEntities("activities", "PartitionKey eq '" + req.route_params.get("userid") + "'", userid=auth["userid"], connectionproperty="PartitionKey")
-
-        count = 0
-        ascent = 0
-        descent = 0
-        distance = 0
-        time = 0
-    
-        for e in qe:
-            if e.get("ascent",0) > 0:
-                ascent += e["ascent"]
-            if e.get("descent",0) > 0:
-                descent += e["descent"]
-            if e.get("distance",0) > 0:
-                distance += e["distance"]
-            if e.get("time",0) > 0:
-                time += e["time"]
-            count += 1
+        # totals are a point read of the precomputed statistics entity
+        # users without one have them computed for this response and saved by statisticsrebuild from the statistics queue
+        userid = req.route_params.get("userid")
+        rowkey = "all"
+        if req.params.get("activitytype") != None:
+            rowkey = "activitytype_" + req.params.get("activitytype")
+        totals = activityTotals()
+        if userid == auth["userid"] or userid in getConnections(auth["userid"], True):
+            qe = queryEntities("statistics", "PartitionKey eq '" + userid + "' and RowKey eq '" + rowkey + "'", ["count", "ascent", "descent", "distance", "time"])
+            if len(qe) > 0:
+                totals = qe[0]
+            elif len(queryEntities("statistics", "PartitionKey eq '" + userid + "' and RowKey eq 'all'", ["RowKey"])) == 0:
+                totals = computeStatistics(userid).get(rowkey, totals)
+                statisticsqueue.set(json.dumps({"userid": userid}))
+
+        count = totals.get("count", 0)
+        ascent = totals.get("ascent", 0)
+        descent = totals.get("descent", 0)
+        distance = totals.get("distance", 0)
+        time = totals.get("time", 0)
     
         response = {}
         response["count"] = count
@@ -464,6 +1645,19 @@ def statistics(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
+@app.queue_trigger(arg_name="msg", queue_name="statistics", connection="storageaccount_connectionstring")
+@app.queue_output(arg_name="statisticsqueue", queue_name="statistics", connection="storageaccount_connectionstring")
+def statisticsrebuild(msg: func.QueueMessage, statisticsqueue: func.Out[typing.List[str]]) -> None:
+    logging.info('called statisticsrebuild')
+    job = json.loads(msg.get_body().decode())
+    if job.get("allusers"):
+        # operator backfill, one message per account so each user is rebuilt and retried on its own
+        statisticsqueue.set([json.dumps({"userid": e["PartitionKey"]}) for e in queryEntities("users", "RowKey eq 'account'", ["PartitionKey"])])
+        return
+    # totals already built are kept current by the write paths, so only missing ones are rebuilt unless forced
+    if job.get("force") or len(queryEntities("statistics", "PartitionKey eq '" + job["userid"] + "' and RowKey eq 'all'", ["RowKey"])) == 0:
+        rebuildStatistics(job["userid"])
+
 @app.route(route="whoami", methods=[func.HttpMethod.GET])
 def whoami(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('called whoami')
@@ -475,14 +1669,22 @@ def whoami(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
+@app.route(route="cachestatistics", methods=[func.HttpMethod.GET])
+def cachestatistics(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('called cachestatistics')
+    try:
+        auth = authorizer(req)
+        if not auth["authorized"]:
+            return createJsonHttpResponse(401, "unauthorized")
+        return func.HttpResponse(json.dumps({"caches": cacheStatistics()}), status_code=200, mimetype="application/json")
+    except Exception as ex:
+        return createJsonHttpResponse(500, str(ex))
+
 @app.route(route="upload/activity", methods=[func.HttpMethod.POST])
-def uploadactivity(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="artifactqueue", queue_name="artifacts", connection="storageaccount_connectionstring")
+def uploadactivity(req: func.HttpRequest, artifactqueue: func.Out[str]) -> func.HttpResponse:
 
-    import geopandas
     import pyogrio
-    from staticmap import StaticMap, Line
-    from shapely.geometry import LineString
-    from garmin_fit_sdk import Decoder, Stream
 
     logging.info('called uploadactivity')
 
@@ -528,58 +1730,22 @@ def uploadactivity(req: func.HttpRequest) -> func.HttpResponse:
             activityproperties["gearid"] = gearid
 
         if extension == "gpx":
-            # convert to geojson
-            dataframe = pyogrio.read_dataframe(upload, layer="track_points")
-            geojson = BytesIO()
-            pyogrio.write_dataframe(dataframe, geojson, driver="GeoJSON", layer="track_points")
-            # convert to activityModel
-            activitydata = parseActivityData(json.loads(geojson.getvalue().decode()))
+            columns = parseGpxColumns(upload)
+            if columns == None:
+                # fall back to gdal for gpx files the streaming reader cannot handle
+                dataframe = pyogrio.read_dataframe(upload, layer="track_points")
+                geojson = BytesIO()
+                pyogrio.write_dataframe(dataframe, geojson, driver="GeoJSON", layer="track_points")
+                # convert to activityModel
+                columns = activityDataColumns(parseActivityData(json.loads(geojson.getvalue().decode()))["data"])
         elif extension == "fit":
-            messages, errors = Decoder(Stream.from_bytes_io(BytesIO(upload))).read()
-            activitydata = {}
-            activitydata["version"] = 1
-            activitydata["data"] = []
-            for m in messages["record_mesgs"]:
-                ad = {}
-                try:
-                    elevation = 0
-                    if "enhance_altitude" in m:
-                        elevation = float(m["enhance_altitude"])
-                    elif "altitude" in m:
-                        elevation = float(m["altitude"])
-                    ad["elevation"] = elevation
-                    ad["longitude"] = float(m["position_long"]) / 11930465
-                    ad["latitude"] = float(m["position_lat"]) / 11930465
-                    ad["timestamp"] = m["timestamp"].isoformat()
-                    activitydata["data"].append(ad)
-                except:
-                    pass
+            columns = parseFitColumns(upload)
         else:
             raise Exception("invalid extension")
+        activitydata = columnsToActivityData(columns)
         
         # calculate statistics
-        statisticsdata = parseStatisticsData(activitydata["data"])
-
-        # create clean track file
-        points = []
-        for point in activitydata["data"]:
-            points.append([point["longitude"],point["latitude"]])
-        route = geopandas.GeoSeries([LineString(points)])
-        routejson = json.loads(route.to_json())
-
-        # create preview
-        routejsonsimplified = json.loads(route.simplify(.0001).to_json())
-        m = StaticMap(300, 300, padding_x=10, padding_y=10, url_template='http://a.tile.osm.org/{z}/{x}/{y}.png')
-        m.add_line(Line(routejsonsimplified["features"][0]["geometry"]["coordinates"], 'red', 3))
-        preview = BytesIO()
-        image = m.render()
-        image.save(preview, optimize=True, quality=100, format="JPEG")
-
-        # save file, geojson, activityData, preview to storage container
-        saveBlob(upload, activityid + "/source.gpx", "application/gpx+xml")
-        saveBlob(json.dumps(routejson).encode(), activityid + "/geojson.json", "application/json")
-        saveBlob(json.dumps(activitydata).encode(), activityid + "/activitydata.json", "application/json")
-        saveBlob(preview.getvalue(), activityid + "/preview.jpg", "image/jpeg")
+        statisticsdata = parseStatisticsColumns(columns)
 
         # capture optional form information
         properties_capture = ["name", "description"]
@@ -595,23 +1761,65 @@ def uploadactivity(req: func.HttpRequest) -> func.HttpResponse:
         activityproperties["descent"] = statisticsdata["descent"]
         activityproperties["starttime"] = statisticsdata["starttime"]
         activityproperties["gps"] = 1
-
-        # capture distance for gear
-        if len(gearid) > 0 and gearid != "none":
-            incrementDecrement("gear", auth["userid"], gearid, "distance", activityproperties["distance"], False)
-
-        # save statistics to tblsvc
+        activityproperties["artifactstatus"] = "pending"
+        activityproperties["feedkey"] = feedRowKey(time.time(), activityid)
         activityproperties = fixTypes(activityproperties, {"name":"string","description":"string","time":"int","distance":"float","ascent":"float","descent":"float","gps":"int"})
         activityproperties = escapeHtml(activityproperties, ["name", "description"])
-        upsertEntity("activities", activityproperties)
+
+        # save file and activityData to storage container, gear distance and feed entries to tblsvc
+        # those writes run concurrently and the activity entity is written last, once they have all succeeded,
+        # so the activity never exists without its data, and everything is undone if any write fails
+        # feed entries written before the activity are skipped by readers until it exists
+        # geojson and preview are created afterwards by activityartifacts from the artifacts queue
+        steps = []
+        for data, name, contenttype in [
+                (upload, activityid + "/source.gpx", "application/gpx+xml"),
+                (json.dumps(activitydata).encode(), activityid + "/activitydata.json", "application/json")]:
+            steps.append((functools.partial(saveBlob, data, name, contenttype, name.endswith(".json")), functools.partial(deleteBlob, name)))
+        if len(gearid) > 0 and gearid != "none":
+            steps.append((functools.partial(incrementDecrement, "gear", auth["userid"], gearid, "distance", activityproperties["distance"], False),
+                          functools.partial(incrementDecrement, "gear", auth["userid"], gearid, "distance", -1 * activityproperties["distance"], False)))
+        feedtargets = feedTargets(auth["userid"], activityproperties["visibilitytype"])
+        steps.append((functools.partial(writeFeedEntries, feedtargets, auth["userid"], activityid, activityproperties["feedkey"]), functools.partial(deleteFeedEntries, feedtargets, activityproperties["feedkey"])))
+        runCommit(steps, functools.partial(upsertEntity, "activities", activityproperties))
+        artifactqueue.set(json.dumps({"userid": auth["userid"], "activityid": activityid}))
+        # the activity is committed at this point, totals that fail to update are repaired by create/statistics
+        try:
+            adjustStatistics(auth["userid"], activityproperties, 1, rebuild=True)
+        except Exception as ex:
+            logging.warning("statistics not updated for " + activityid + ": " + str(ex))
         
         return createJsonHttpResponse(201, "successfully uploaded activity", {"activityid": activityid})
 
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
+@app.queue_trigger(arg_name="msg", queue_name="artifacts", connection="storageaccount_connectionstring")
+def activityartifacts(msg: func.QueueMessage) -> None:
+    logging.info('called activityartifacts')
+    job = json.loads(msg.get_body().decode())
+    try:
+        updateEntity("activities", {"PartitionKey": job["userid"], "RowKey": job["activityid"], "artifactstatus": "processing"})
+    except ResourceNotFoundError:
+        logging.info("activity " + job["activityid"] + " no longer exists, skipping artifacts")
+        return
+    try:
+        createActivityArtifacts(job["activityid"])
+        updateEntity("activities", {"PartitionKey": job["userid"], "RowKey": job["activityid"], "artifactstatus": "ready"})
+    except Exception as ex:
+        # the message is retried by the runtime until maxDequeueCount, after which it moves to the poison queue
+        status = "pending"
+        if msg.dequeue_count >= int(os.environ.get("artifactmaxattempts", "5")):
+            status = "failed"
+        try:
+            updateEntity("activities", {"PartitionKey": job["userid"], "RowKey": job["activityid"], "artifactstatus": status, "artifacterror": str(ex)})
+        except:
+            pass
+        raise
+
 @app.route(route="upload/media/{activityid}", methods=[func.HttpMethod.POST])
-def uploadmedia(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="mediaqueue", queue_name="media", connection="storageaccount_connectionstring")
+def uploadmedia(req: func.HttpRequest, mediaqueue: func.Out[str]) -> func.HttpResponse:
     logging.info('called uploadmedia')
     try:
         auth = authorizer(req)
@@ -624,30 +1832,99 @@ def uploadmedia(req: func.HttpRequest) -> func.HttpResponse:
             return createJsonHttpResponse(400, "missing upload file")
         mediaid = str(uuid.uuid4())
         try:
+            from PIL import Image
             upload = req.files["upload"].stream.read()
-            preview = resizeImage(BytesIO(upload), (300, 300), 80)
-            full = resizeImage(BytesIO(upload), (1200, 1200), 95)
+            # only the header is read here, derivatives are made by mediaderivatives from the media queue
+            Image.open(BytesIO(upload))
             saveBlob(upload, req.route_params.get("activityid") + "/media/" + mediaid + "_original", req.files["upload"].content_type)
-            saveBlob(preview, req.route_params.get("activityid") + "/media/" + mediaid + "_preview", "image/jpeg")
-            saveBlob(full, req.route_params.get("activityid") + "/media/" + mediaid + "_full", "image/jpeg")
-            qe = queryEntities("media", "PartitionKey eq '" + activityid + "'")
-            sort = 0
-            if len(qe) > 0:
-                for e in qe:
-                    if e["sort"] > sort:
-                        sort = e["sort"]
-            upsertEntity("media",{
+            createMediaEntities(activityid, [{
                 "PartitionKey": activityid,
                 "RowKey": mediaid,
                 "filename": req.files["upload"].filename,
-                "sort": sort + 1
-            })
+                "mediastatus": "pending"
+            }])
+            mediaqueue.set(json.dumps({"activityid": activityid, "mediaid": mediaid}))
             return createJsonHttpResponse(201, "successfully uploaded media", {"mediaid": mediaid})
         except:
             return createJsonHttpResponse(400, "media unsuccesful due to bad data or misunderstood format")
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
+@app.route(route="upload/mediabatch/{activityid}", methods=[func.HttpMethod.POST])
+@app.queue_output(arg_name="mediaqueue", queue_name="media", connection="storageaccount_connectionstring")
+def uploadmediabatch(req: func.HttpRequest, mediaqueue: func.Out[typing.List[str]]) -> func.HttpResponse:
+    logging.info('called uploadmediabatch')
+    try:
+        auth = authorizer(req)
+        if not auth["authorized"]:
+            return createJsonHttpResponse(401, "unauthorized")
+        activityid = req.route_params.get("activityid")
+        if len(queryEntities("activities", "PartitionKey eq '" + auth['userid'] + "' and RowKey eq '" + activityid + "'")) == 0:
+            return createJsonHttpResponse(403, "must be owner of activity to upload media")
+        files = req.files.getlist("upload")
+        if len(files) == 0:
+            return createJsonHttpResponse(400, "missing upload file")
+        # a table transaction holds at most 100 entities, one of them the ~sort counter
+        batchsize = min(int(os.environ.get("mediabatchsize", "20")), 99)
+        if len(files) > batchsize:
+            return createJsonHttpResponse(400, "too many files, at most " + str(batchsize) + " per upload")
+        from PIL import Image
+        uploads = []
+        for f in files:
+            upload = f.stream.read()
+            try:
+                Image.open(BytesIO(upload))
+            except:
+                return createJsonHttpResponse(400, "media unsuccesful due to bad data or misunderstood format", {"filename": f.filename})
+            uploads.append((str(uuid.uuid4()), f, upload))
+
+        entities = []
+        steps = []
+        for mediaid, f, upload in uploads:
+            entities.append({"PartitionKey": activityid, "RowKey": mediaid, "filename": f.filename, "mediastatus": "pending"})
+            name = activityid + "/media/" + mediaid + "_original"
+            steps.append((functools.partial(saveBlob, upload, name, f.content_type), functools.partial(deleteBlob, name)))
+
+        # originals are stored concurrently, then every media entity is written in one transaction with sort orders in the order the files were sent
+        runCommit(steps, functools.partial(createMediaEntities, activityid, entities))
+        mediaqueue.set([json.dumps({"activityid": activityid, "mediaid": e["RowKey"]}) for e in entities])
+        return createJsonHttpResponse(201, "successfully uploaded media", {"mediaids": [e["RowKey"] for e in entities]})
+    except Exception as ex:
+        return createJsonHttpResponse(500, str(ex))
+
+@app.queue_trigger(arg_name="msg", queue_name="media", connection="storageaccount_connectionstring")
+def mediaderivatives(msg: func.QueueMessage) -> None:
+    logging.info('called mediaderivatives')
+    job = json.loads(msg.get_body().decode())
+    try:
+        updateEntity("media", {"PartitionKey": job["activityid"], "RowKey": job["mediaid"], "mediastatus": "processing"})
+    except ResourceNotFoundError:
+        logging.info("media " + job["mediaid"] + " no longer exists, skipping derivatives")
+        return
+    try:
+        gb = getBlob(job["activityid"] + "/media/" + job["mediaid"] + "_original")
+        if not gb["status"]:
+            raise Exception("original not found for " + job["mediaid"])
+        with getMediaSemaphore():
+            derivatives = processImage(gb["data"])
+        steps = []
+        for name in derivatives.keys():
+            for data, contenttype, suffix in derivatives[name]:
+                steps.append((functools.partial(saveBlob, data, job["activityid"] + "/media/" + job["mediaid"] + "_" + name + suffix, contenttype), None))
+        runCommit(steps)
+        formats = [suffix[1:] for data, contenttype, suffix in list(derivatives.values())[0] if suffix != ""]
+        updateEntity("media", {"PartitionKey": job["activityid"], "RowKey": job["mediaid"], "mediastatus": "ready", "mediaformats": ",".join(formats)})
+    except Exception as ex:
+        # retried by the runtime like activityartifacts
+        status = "pending"
+        if msg.dequeue_count >= int(os.environ.get("artifactmaxattempts", "5")):
+            status = "failed"
+        try:
+            updateEntity("media", {"PartitionKey": job["activityid"], "RowKey": job["mediaid"], "mediastatus": status, "mediaerror": str(ex)})
+        except:
+            pass
+        raise
+
 @app.route(route="activities/{userid?}/{activityid?}", methods=[func.HttpMethod.GET])
 def activities(req: func.HttpRequest) -> func.HttpResponse:
 
@@ -661,6 +1938,7 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
 
         feedresponse = True
         userresponse = False
+        cursorresponse = False
         filter = ""
 
         delta = 86400*7
@@ -668,11 +1946,19 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
         if "activityid" not in req.route_params.keys() and "userid" in req.route_params.keys():
             userresponse = True
 
+        # private activities are only shown to their owner, and out of sync old stuff is not shown on the main feed
+        def include(a):
+            if (a.get("visibilitytype", "") == "private") and (a.get("userid") != auth["userid"]):
+                return False
+            return (tsIsoToUnix(a['timestamp']) - tsIsoToUnix(a['starttime']) < delta or userresponse) or not feedresponse
+
         if "activityid" in req.route_params.keys() and "userid" not in req.route_params.keys():
             return createJsonHttpResponse(400, "activityid must be accompanied by a userid")
         elif "activityid" in req.route_params.keys() and "userid" in req.route_params.keys():
             feedresponse = False
             filter +=  "PartitionKey eq '" + req.route_params.get("userid") + "'" + " and RowKey eq '" + req.route_params.get("activityid") + "'"
+        elif "endtime" not in req.params.keys() and "starttime" not in req.params.keys():
+            cursorresponse = True
         else:
             endtime = 0
             starttime = 0
@@ -688,37 +1974,58 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
             if "userid" in req.route_params.keys():
                 filter += " and PartitionKey eq '" + req.route_params.get("userid") + "'"
 
-        allactivities = queryEntities("activities", 
-            filter,
-            aliases={"PartitionKey": "userid", "RowKey": "activityid"},
-            sortproperty="timestamp", 
-            sortreverse=True,
-            userid=auth["userid"],
-            connectionproperty="PartitionKey")
-
-        # activity privacy, max count
-        # this got a bit complicated
-        # ordering had to be switched to timestamp instead of starttime, which may be confusing in the feed
-        # BUT this is the only way to not drop activities, as there could be diffs in starttime vs timestamp
-        # in full feed, activities >delta are skipped for display to discourage edit spamming to the top of the list
-        activities = []
-        activitycnt = 0
-        track_timestamp = 999999999999
-        for a in allactivities:
-            if activitycnt == 10: 
-                starttime = int(track_timestamp)
-                break
-            if ((a.get("visibilitytype", "") != "private") or (a.get("userid") == auth["userid"])):
-                # dont show out of sync old stuff if on main feed
-                if (tsIsoToUnix(a['timestamp']) - tsIsoToUnix(a['starttime']) < delta or userresponse) or not feedresponse: 
+        if cursorresponse:
+            # cursor feed, pages are filled from newest to oldest and nexturl carries an opaque cursor
+            pagesize = min(int(req.params.get("pagesize", os.environ.get("feedpagesize", "10"))), int(os.environ.get("feedmaxpagesize", "50")))
+            if pagesize < 1:
+                raise Exception("pagesize must be at least 1")
+            cursor = None
+            if "cursor" in req.params.keys():
+                cursor = decodeCursor(req.params.get("cursor"))
+            activities, nextcursor = activityFeedPage(auth["userid"], req.route_params.get("userid"), pagesize, cursor, include)
+        else:
+            allactivities = queryEntities("activities", 
+                filter,
+                aliases={"PartitionKey": "userid", "RowKey": "activityid"},
+                sortproperty="timestamp", 
+                sortreverse=True,
+                userid=auth["userid"],
+                connectionproperty="PartitionKey")
+
+            # activity privacy, max count
+            # this got a bit complicated
+            # ordering had to be switched to timestamp instead of starttime, which may be confusing in the feed
+            # BUT this is the only way to not drop activities, as there could be diffs in starttime vs timestamp
+            # in full feed, activities >delta are skipped for display to discourage edit spamming to the top of the list
+            activities = []
+            activitycnt = 0
+            track_timestamp = 999999999999
+            for a in allactivities:
+                if activitycnt == 10: 
+                    starttime = int(track_timestamp)
+                    break
+                if include(a):
                     activities.append(a)
                     activitycnt += 1
                     track_timestamp = min(track_timestamp, tsIsoToUnix(a['timestamp']))
             
         activitytypes = {}
 
-        for e in queryEntities("validate", "PartitionKey eq 'activitytype'"):
+        for e in getValidations()["types"].get("activitytype", []):
             activitytypes[e.get("RowKey")] = e.get("label")
+
+        # side tables are fetched for the whole page at once and joined by activityid
+        activityids = [a["activityid"] for a in activities]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            mediafuture = executor.submit(queryEntitiesByPartition, "media", activityids, ["RowKey", "sort", "mediastatus"], {"RowKey": "mediaid"}, "sort", False, "RowKey lt '~'")
+            propsfuture = executor.submit(queryEntitiesByPartition, "props", activityids, ["RowKey","createtime"], {"RowKey": "userid"}, "createtime")
+            commentsfuture = executor.submit(queryEntitiesByPartition, "comments", activityids, ["RowKey","userid","createtime","comment"], {"RowKey": "commentid"}, "createtime")
+            gearfuture = None
+            if not feedresponse and len(activities) > 0 and activities[0].get("gearid", None) != None:
+                gearfuture = executor.submit(queryEntities, "gear", "PartitionKey eq '" + activities[0]["userid"] + "' and RowKey eq '" + activities[0]["gearid"] + "'", ["RowKey","distance","name"], {"RowKey": "gearid"})
+            media = mediafuture.result()
+            props = propsfuture.result()
+            comments = commentsfuture.result()
         
         for a in activities:
 
@@ -729,27 +2036,33 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
             else:
                 gps = False
 
+            # activities from before the artifacts queue have no artifactstatus and are ready
+            a["artifactstatus"] = a.get("artifactstatus", "ready")
             if gps:
-                a["previewurl"] = "data/preview/" + a["activityid"]
+                if a["artifactstatus"] == "ready":
+                    a["previewurl"] = "data/preview/" + a["activityid"]
                 a["gps"] = 1
             else:
                 a["gps"] = 0
 
             # media
-            qe = queryEntities("media", "PartitionKey eq '" + a["activityid"] + "'", ["RowKey", "sort"], {"RowKey": "mediaid"}, "sort")
+            qe = media[a["activityid"]]
+            # media from before the media queue has no mediastatus and is ready
             for e in qe:
-                e["mediapreviewurl"] = "data/mediapreview/" + a["activityid"] + "/" + e["mediaid"]
-                e["mediafullurl"] = "data/mediafull/" + a["activityid"] + "/" + e["mediaid"]
+                e["mediastatus"] = e.get("mediastatus", "ready")
+                if e["mediastatus"] == "ready":
+                    e["mediapreviewurl"] = "data/mediapreview/" + a["activityid"] + "/" + e["mediaid"]
+                    e["mediafullurl"] = "data/mediafull/" + a["activityid"] + "/" + e["mediaid"]
             a["media"] = qe
 
             # props
-            qe = queryEntities("props", "PartitionKey eq '" + a["activityid"] + "'", ["RowKey","createtime"], {"RowKey": "userid"}, "createtime")
+            qe = props[a["activityid"]]
             for e in qe:
                 e["createtime"] = launderTimezone(e["createtime"], auth["timezone"])
             a["props"] = qe
 
             # comments
-            qe = queryEntities("comments", "PartitionKey eq '" + a["activityid"] + "'", ["RowKey","userid","createtime","comment"], {"RowKey": "commentid"}, "createtime")
+            qe = comments[a["activityid"]]
             for e in qe:
                 e["createtime"] = launderTimezone(e["createtime"], auth["timezone"])
             a["comments"] = qe
@@ -773,16 +2086,17 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
             
             # add gear, include track path for single activity response
             if not feedresponse:
-                if a.get("gearid", None) != None:
-                    qe = queryEntities("gear", "PartitionKey eq '" + a["userid"] + "' and RowKey eq '" + a["gearid"] + "'", ["RowKey","distance","name"], {"RowKey": "gearid"})
+                if gearfuture != None:
+                    qe = gearfuture.result()
                     if len(qe)>0:
                         a["gear"] = qe[0]
                         a["gear"]["distance"] = launderUnits(auth["unitsystem"], "distance", in_distance=a["gear"]["distance"])
-                a["trackurl"] = "data/geojson/" + a["activityid"]
+                if a["artifactstatus"] == "ready":
+                    a["trackurl"] = "data/geojson/" + a["activityid"]
                 a["activityurl"] = "data/activity/" + a["activityid"]
 
             # exclude certain properties and customize response based on type
-            excludeproperties = ["timestamp","gearid"]
+            excludeproperties = ["timestamp","gearid","artifacterror","feedkey"]
             if a_distance == 0:
                 excludeproperties += ["distance","speed"]
             if a_ascent == 0:
@@ -798,8 +2112,19 @@ def activities(req: func.HttpRequest) -> func.HttpResponse:
             nexturl = "activities"
             if "userid" in req.route_params.keys():
                 nexturl += "/" + req.route_params.get("userid")
-            nexturl += "?endtime=" + str(starttime) + "&starttime=" + str(starttime - delta)
-            response["nexturl"] = nexturl
+            if not cursorresponse:
+                nexturl += "?endtime=" + str(starttime) + "&starttime=" + str(starttime - delta)
+                response["nexturl"] = nexturl
+            elif nextcursor != None:
+                nexturl += "?cursor=" + encodeCursor(nextcursor)
+                if "pagesize" in req.params.keys():
+                    nexturl += "&pagesize=" + str(pagesize)
+                response["nexturl"] = nexturl
+            else:
+                # the feed only goes back to since, older activities carry on with window paging from there
+                since = feedBuilt(auth["userid"])
+                nexturl += "?endtime=" + str(since) + "&starttime=" + str(since - delta)
+                response["nexturl"] = nexturl
 
         return func.HttpResponse(json.dumps(response), status_code=200, mimetype="application/json")
 
@@ -814,27 +2139,97 @@ def data(req: func.HttpRequest) -> func.HttpResponse:
         datatype = req.route_params.get("datatype")
         if not validateData("datatype", datatype)["status"]:
             return createJsonHttpResponse(400, "invalid datatype")
-        match datatype:
-            case "preview":
-                gb = getBlob(req.route_params.get("id") + "/preview.jpg")
-                if not gb["status"]:
-                    gb = getBlob(req.route_params.get("id") + "/preview.png")
-            case "activity":
+        # compact formats are opted into with the Accept header, plain json stays the default
+        accept = req.headers.get("Accept", "")
+        representation = ""
+        if datatype == "geojson" and "application/vnd.outsidely.polyline" in accept:
+            representation = "polyline"
+        elif datatype == "activity" and "application/vnd.outsidely.columns+json" in accept:
+            representation = "columns"
+        conditions = requestConditions(req, representation)
+
+        # level of detail for geojson, zoom is a web map zoom level and tolerance is in degrees
+        for name, maximum in [("zoom", 30), ("tolerance", 360)]:
+            if req.params.get(name) != None:
                 try:
-                    gb = getBlob(req.route_params.get("id") + "/activitydata.json")
-                except:
-                    gb = getBlob(req.route_params.get("id") + "/activityData.json")
-            case "geojson":
-                gb = getBlob(req.route_params.get("id") + "/geojson.json")
-            case "mediapreview":
-                gb = getBlob(req.route_params.get("id") + "/media/" + req.route_params.get("id2") + "_preview")
-            case "mediafull":
-                gb = getBlob(req.route_params.get("id") + "/media/" + req.route_params.get("id2") + "_full")
-            case _:
-                return createJsonHttpResponse(400, "invalid datatype")
+                    value = float(req.params.get(name))
+                except ValueError:
+                    value = float("nan")
+                if not 0 <= value <= maximum:
+                    return createJsonHttpResponse(400, name + " must be a number from 0 to " + str(maximum))
+
+        # ranges apply to the stored bytes, so they are only honoured for unconverted data
+        byterange = None
+        if representation == "" and "If-Range" not in req.headers:
+            byterange = requestRange(req)
+
+        # responses cannot be streamed, so whole objects are only read up to datamaxbody and larger ones must be fetched in ranges
+        maxsize = int(os.environ.get("datamaxbody", str(32 * 1024 * 1024)))
+
+        def fetch(byterange):
+            match datatype:
+                case "preview" if byterange == None:
+                    gb = getCachedBlob(req.route_params.get("id") + "/preview.jpg", conditions)
+                    if not gb["status"]:
+                        gb = getCachedBlob(req.route_params.get("id") + "/preview.png", conditions)
+                case "preview":
+                    gb = getBlob(req.route_params.get("id") + "/preview.jpg", True, conditions, byterange, maxsize)
+                    if not gb["status"]:
+                        gb = getBlob(req.route_params.get("id") + "/preview.png", True, conditions, byterange, maxsize)
+                case "activity":
+                    try:
+                        gb = getBlob(req.route_params.get("id") + "/activitydata.json", False, conditions, byterange, maxsize)
+                    except:
+                        gb = getBlob(req.route_params.get("id") + "/activityData.json", False, conditions, byterange, maxsize)
+                case "geojson":
+                    gb = getTrackBlob(req.route_params.get("id"), req.params.get("zoom"), req.params.get("tolerance"), False, conditions, byterange, maxsize)
+                case "mediapreview" | "mediafull":
+                    # webp or avif derivatives are preferred when they were stored for the object and the client accepts them
+                    name = req.route_params.get("id") + "/media/" + req.route_params.get("id2") + "_" + datatype[5:]
+                    suffixes = [""]
+                    if "image/webp" in accept or "image/avif" in accept:
+                        suffixes = ["_" + f for f in storedMediaFormats(req.route_params.get("id"), req.route_params.get("id2")) if "image/" + f in accept] + suffixes
+                    for suffix in suffixes:
+                        if datatype == "mediapreview" and byterange == None:
+                            gb = getCachedBlob(name + suffix, conditions)
+                        else:
+                            gb = getBlob(name + suffix, True, conditions, byterange, maxsize)
+                        if gb["status"]:
+                            break
+                case _:
+                    gb = None
+            return gb
+
+        gb = fetch(byterange)
+        if gb == None:
+            return createJsonHttpResponse(400, "invalid datatype")
+        if gb.get("range") != None and gb["contentencoding"] != None and not acceptsEncoding(req, gb["contentencoding"]):
+            # a slice of an encoded blob cannot be decoded for the client, so send it whole
+            gb = fetch(None)
+        if gb.get("toolarge"):
+            return createJsonHttpResponse(413, "data is larger than " + str(maxsize) + " bytes, request it in parts with Range", {"size": gb["size"]})
         if not gb["status"]:
             return createJsonHttpResponse(404, "data not found")
-        return func.HttpResponse(gb["data"], status_code=200, mimetype=gb["contenttype"])
+        headers = cacheHeaders(gb, representation)
+        if gb["notmodified"]:
+            return func.HttpResponse(status_code=304, headers=headers)
+        if gb.get("range") != None:
+            headers["Accept-Ranges"] = "bytes"
+            start, end, size = gb["range"]
+            if start == None:
+                headers["Content-Range"] = "bytes */" + str(size)
+                return func.HttpResponse(status_code=416, headers=headers)
+            headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(size)
+            if gb["contentencoding"] != None:
+                headers["Content-Encoding"] = gb["contentencoding"]
+            return func.HttpResponse(gb["data"], status_code=206, mimetype=gb["contenttype"], headers=headers)
+        if representation == "polyline":
+            routejson = json.loads(decodeContent(gb["data"], gb["contentencoding"]))
+            gb = {"data": encodePolyline(routejson["features"][0]["geometry"]["coordinates"]).encode(), "contenttype": "application/vnd.outsidely.polyline", "contentencoding": None}
+        elif representation == "columns":
+            activitydata = json.loads(decodeContent(gb["data"], gb["contentencoding"]))
+            gb = {"data": json.dumps(encodeActivityColumns(activitydata), separators=(",", ":")).encode(), "contenttype": "application/vnd.outsidely.columns+json", "contentencoding": None}
+        return encodedHttpResponse(req, gb, headers, representation == "")
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
@@ -847,7 +2242,15 @@ def validate(req: func.HttpRequest) -> func.HttpResponse:
             return createJsonHttpResponse(401, "unauthorized")
         if not validateData("validationtype", req.route_params.get("validationtype"))["status"]:
             return createJsonHttpResponse(400, "invalid validationtype")
-        data = queryEntities("validate", "PartitionKey eq '" + req.route_params.get("validationtype") + "'",["RowKey","label","sort"],{"RowKey": req.route_params["validationtype"]}, "sort")
+        data = []
+        for e in getValidations()["types"].get(req.route_params.get("validationtype"), []):
+            validation = {k: e[k] for k in ["label", "sort"] if k in e}
+            validation[req.route_params["validationtype"]] = e["RowKey"]
+            data.append(validation)
+        try:
+            data.sort(key=lambda s: s["sort"])
+        except:
+            raise Exception("Error in sorting, likely due to missing property in response or entity")
         return func.HttpResponse(json.dumps({"validations":data}), status_code=200, mimetype="application/json")
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
@@ -961,6 +2364,7 @@ def newuser(req: func.HttpRequest) -> func.HttpResponse:
             "RowKey": req.route_params.get("id", ""),
             "connectiontype": "connected"
         })
+        invalidateConnections([req.route_params.get("id", ""), userid])
         createNotification(req.route_params.get("id", ""), "You are now connected to " + userid + ".")
         createNotification(userid, "You are now connected to " + req.route_params.get("id", "") + ".")
 
@@ -1038,7 +2442,7 @@ def create(req: func.HttpRequest) -> func.HttpResponse:
         try:
             body = req.get_json()
         except:
-            if req.route_params.get("type") != "prop" and req.route_params.get("type") != "invitation" and req.route_params.get("type") != "recoveryid":
+            if req.route_params.get("type") not in ["prop", "invitation", "recoveryid", "statistics"]:
                 return createJsonHttpResponse(400, "bad json data")
         id = {}
         match req.route_params.get("type"):
@@ -1073,10 +2477,17 @@ def create(req: func.HttpRequest) -> func.HttpResponse:
                 body["PartitionKey"] = auth["userid"]
                 body["RowKey"] = activityid
                 body["gps"] = 0
+                body["feedkey"] = feedRowKey(time.time(), activityid)
 
                 body = fixTypes(body, {"name":"string","description":"string","ascent": "float","descent":"float","distance":"float","time": "int","gps":"int"})
                 body = escapeHtml(body, ["name", "description"])
                 upsertEntity("activities", body)
+                writeFeedEntries(feedTargets(auth["userid"], body.get("visibilitytype")), auth["userid"], activityid, body["feedkey"])
+                # the activity is committed at this point, totals that fail to update are repaired by create/statistics
+                try:
+                    adjustStatistics(auth["userid"], body, 1, rebuild=True)
+                except Exception as ex:
+                    logging.warning("statistics not updated for " + activityid + ": " + str(ex))
                 id["activityid"] = activityid
                 # capture distance for gear
                 if len(body.get("gearid",""))>0 and body.get("gearid","") != 'none': 
@@ -1111,8 +2522,8 @@ def create(req: func.HttpRequest) -> func.HttpResponse:
 
                 # if this is a rejection, then remove the records
                 if body["connectiontype"] == "rejected":
-                    deleteEntity("connections", auth["userid"], body["userid"])
-                    deleteEntity("connections", body["userid"], auth["userid"])
+                    deleteEntities("connections", [{"PartitionKey": auth["userid"], "RowKey": body["userid"]}, {"PartitionKey": body["userid"], "RowKey": auth["userid"]}])
+                    invalidateConnections([auth["userid"], body["userid"]])
                     return createJsonHttpResponse(200, "connection rejected")
                 
                 # submitting user is confirmed by action
@@ -1141,16 +2552,14 @@ def create(req: func.HttpRequest) -> func.HttpResponse:
 
                 # if both users are confirmed, set to connected
                 if len(queryEntities("connections", "(PartitionKey eq '" + auth["userid"] + "' and RowKey eq '" + body["userid"] + "' and connectiontype eq 'confirmed') or (PartitionKey eq '" + body["userid"] + "' and RowKey eq '" + auth["userid"] + "' and connectiontype eq 'confirmed')")) == 2:
-                    upsertEntity("connections", {
-                        "PartitionKey": auth["userid"],
-                        "RowKey": body["userid"],
-                        "connectiontype": "connected"
-                    })
-                    upsertEntity("connections", {
-                        "PartitionKey": body["userid"],
-                        "RowKey": auth["userid"],
-                        "connectiontype": "connected"
-                    })
+                    submitEntities("connections", [
+                        ("upsert", {"PartitionKey": auth["userid"], "RowKey": body["userid"], "connectiontype": "connected"}),
+                        ("upsert", {"PartitionKey": body["userid"], "RowKey": auth["userid"], "connectiontype": "connected"})
+                    ])
+                    invalidateConnections([auth["userid"], body["userid"]])
+                    # each feed gets the other user's activities back to the since it was built with, so window paging carries on from there
+                    backfillFeed(auth["userid"], body["userid"], feedBuilt(auth["userid"]))
+                    backfillFeed(body["userid"], auth["userid"], feedBuilt(body["userid"]))
                     createNotification(auth["userid"], "You are now connected to " + body["userid"] + ".", None, {"userid": body["userid"]})
                     createNotification(body["userid"], "You are now connected to " + auth["userid"] + ".", None, {"userid": auth["userid"]})
             case "prop":
@@ -1167,6 +2576,8 @@ def create(req: func.HttpRequest) -> func.HttpResponse:
                 })
                 if req.route_params.get("id") != auth["userid"]:
                     createNotification(req.route_params.get("id"), auth["userid"] + " gave you props on your activity.", None, {"userid":req.route_params.get("id"),"activityid":req.route_params.get("id2")})
+            case "statistics":
+                rebuildStatistics(auth["userid"])
             case "comment":
                 cjp = checkJsonProperties(body, [{"name":"comment","required":True}])
                 if not cjp["status"]:
@@ -1277,6 +2688,8 @@ def update(req: func.HttpRequest) -> func.HttpResponse:
                     body["salt"] = salt
                     body = escapeHtml(body, ["firstname","lastname"])
                 upsertEntity("users", body)
+                if "unitsystem" in body.keys() or "timezone" in body.keys():
+                    invalidateAuthorizer(auth["userid"])
             case "activity":
                 qe = queryEntities("activities", "PartitionKey eq '" + auth['userid'] + "' and RowKey eq '" + req.route_params.get("id") + "'")
                 if len(qe) == 0:
@@ -1309,6 +2722,21 @@ def update(req: func.HttpRequest) -> func.HttpResponse:
 
                 body = escapeHtml(body, ["name","description"])
                 upsertEntity("activities", body)
+                # connections' feeds gain or lose the activity when it becomes or stops being private
+                oldprivate = qe[0].get("visibilitytype", "") == "private"
+                newprivate = body.get("visibilitytype", qe[0].get("visibilitytype", "")) == "private"
+                if oldprivate != newprivate:
+                    feedkey = activityFeedKey(dict(qe[0], activityid=req.route_params.get("id")))
+                    if newprivate:
+                        deleteFeedEntries(getConnections(auth["userid"]), feedkey)
+                    else:
+                        writeFeedEntries(getConnections(auth["userid"]), auth["userid"], req.route_params.get("id"), feedkey)
+                if "activitytype" in body.keys() and body["activitytype"] != qe[0].get("activitytype"):
+                    try:
+                        adjustStatistics(auth["userid"], qe[0], -1, False)
+                        adjustStatistics(auth["userid"], dict(qe[0], activitytype=body["activitytype"]), 1, False)
+                    except Exception as ex:
+                        logging.warning("statistics not updated for " + req.route_params.get("id") + ": " + str(ex))
             case "gear":
                 if len(queryEntities("gear", "PartitionKey eq '" + auth['userid'] + "' and RowKey eq '" + req.route_params.get("id") + "'")) == 0:
                     return createJsonHttpResponse(404, "resource not found")
@@ -1324,14 +2752,14 @@ def update(req: func.HttpRequest) -> func.HttpResponse:
                     return createJsonHttpResponse(404, "resource not found")
                 if len(queryEntities("activities", "PartitionKey eq '" + auth["userid"] + "' and RowKey eq '" + req.route_params.get("id") + "'")) == 0:
                     return createJsonHttpResponse(403, "must be the activity owner to update media")
-                qe = queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey eq '" + req.route_params.get("id2") + "'")
+                qe = queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey eq '" + req.route_params.get("id2") + "' and RowKey lt '~'")
                 if len(qe) == 0:
                     return createJsonHttpResponse(404, "resource not found")
                 cjp = checkJsonProperties(body, [{"name":"sort"}])
                 if not cjp["status"]:
                     return createJsonHttpResponse(400, cjp["message"])
                 oldsort = int(qe[0].get("sort"))
-                qe = queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey ne '" + req.route_params.get("id2") + "'", aliases={"PartitionKey":"activityid","RowKey":"mediaid"})
+                qe = queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey ne '" + req.route_params.get("id2") + "' and RowKey lt '~'", aliases={"PartitionKey":"activityid","RowKey":"mediaid"})
                 for e in qe:
                     if "sort" in body.keys():
                         if e["sort"] == body["sort"]:
@@ -1349,8 +2777,61 @@ def update(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as ex:
         return createJsonHttpResponse(500, str(ex))
 
+@app.queue_trigger(arg_name="msg", queue_name="deletions", connection="storageaccount_connectionstring")
+@app.queue_output(arg_name="deletequeue", queue_name="deletions", connection="storageaccount_connectionstring")
+def cascadedelete(msg: func.QueueMessage, deletequeue: func.Out[str]) -> None:
+    logging.info('called cascadedelete')
+    job = json.loads(msg.get_body().decode())
+    qe = queryEntities("deletejobs", "PartitionKey eq '" + job["userid"] + "' and RowKey eq '" + job["jobid"] + "'", ["PartitionKey", "RowKey", "jobtype", "activityid", "status", "stage", "checkpoint", "deletedblobs", "deletedentities"])
+    if len(qe) == 0 or qe[0]["status"] == "complete":
+        logging.info("deletion job " + job["jobid"] + " not found or complete, skipping")
+        return
+    entity = qe[0]
+    entity["status"] = "running"
+    stages = deletionStages(entity["jobtype"])
+    deadline = time.time() + int(os.environ.get("deletejobseconds", "240"))
+    try:
+        if deletionTargetExists(entity):
+            raise Exception("the " + entity["jobtype"] + " to delete still exists")
+        while entity["stage"] != "complete":
+            if not runDeletionStage(entity, deadline):
+                # out of time for this invocation, the checkpoint is kept and the job carries on from a new message
+                upsertEntity("deletejobs", entity)
+                deletequeue.set(msg.get_body().decode())
+                return
+            nextstage = stages.index(entity["stage"]) + 1
+            entity["stage"] = stages[nextstage] if nextstage < len(stages) else "complete"
+            entity["checkpoint"] = ""
+            upsertEntity("deletejobs", entity)
+        entity["status"] = "complete"
+        upsertEntity("deletejobs", entity)
+    except Exception as ex:
+        # retried by the runtime from the last checkpoint like activityartifacts
+        entity["status"] = "pending"
+        if msg.dequeue_count >= int(os.environ.get("artifactmaxattempts", "5")):
+            entity["status"] = "failed"
+        entity["error"] = str(ex)
+        try:
+            upsertEntity("deletejobs", entity)
+        except:
+            pass
+        raise
+
+@app.route(route="deletestatus/{userid}/{jobid}", methods=[func.HttpMethod.GET])
+def deletestatus(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('called deletestatus')
+    try:
+        # no token is required since deleted accounts cannot sign in, the jobid returned by delete acts as the key
+        qe = queryEntities("deletejobs", "PartitionKey eq '" + req.route_params.get("userid") + "' and RowKey eq '" + req.route_params.get("jobid") + "'", ["jobtype", "status", "stage", "deletedblobs", "deletedentities"])
+        if len(qe) == 0:
+            return createJsonHttpResponse(404, "resource not found")
+        return func.HttpResponse(json.dumps(qe[0]), status_code=200, mimetype="application/json")
+    except Exception as ex:
+        return createJsonHttpResponse(500, str(ex))
+
 @app.route(route="delete/{type}/{id}/{id2?}", methods=[func.HttpMethod.DELETE])
-def delete(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="deletequeue", queue_name="deletions", connection="storageaccount_connectionstring")
+def delete(req: func.HttpRequest, deletequeue: func.Out[str]) -> func.HttpResponse:
     logging.info('called delete')
     try:
         auth = authorizer(req)
@@ -1362,75 +2843,50 @@ def delete(req: func.HttpRequest) -> func.HttpResponse:
                     return createJsonHttpResponse(403, "accounts can only be deleted by themselves")
                 deleteid = queryEntities("users", "PartitionKey eq '" + auth["userid"] + "' and RowKey eq 'account'")[0]["salt"]
                 if req.route_params.get("id2", "") == deleteid:
-                    activityids = queryEntities("activities", "PartitionKey eq '" + auth["userid"] + "'", ["PartitionKey","RowKey"], {"PartitionKey":"userid","RowKey": "activityid"})
-                    # blobs
-                    for e in activityids:
-                        for b in listBlobs(e["activityid"]):
-                            deleteBlob(b)
-                    # props - does not delete props made by user on other activities
-                    for e in activityids:
-                        for e1 in queryEntities("props", "PartitionKey eq '" + e["activityid"] + "'", ["PartitionKey","RowKey"], {"PartitionKey": "activityid", "RowKey": "userid"}):
-                            deleteEntity("props", e1["activityid"], e1["userid"])
-                    # comments - does not delete comments made by user on other activities
-                    for e in activityids:
-                        for e1 in queryEntities("comments", "PartitionKey eq '" + e["activityid"] + "'", ["PartitionKey","RowKey"], {"PartitionKey": "activityid", "RowKey": "commentid"}):
-                            deleteEntity("comments", e1["activityid"], e1["commentid"])
-                    # media
-                    for e in activityids:
-                        for e1 in queryEntities("media", "PartitionKey eq '" + e["activityid"] + "'", ["PartitionKey","RowKey"], {"PartitionKey": "activityid", "RowKey": "mediaid"}):
-                            deleteEntity("media", e1["activityid"], e1["mediaid"])
-                    # activities
-                    for e in activityids:
-                        deleteEntity("activities", e["userid"], e["activityid"])
-                    # connections
-                    for e in queryEntities("connections", "PartitionKey eq '" + auth["userid"] + "'"):
-                        deleteEntity("connections", e["PartitionKey"], e["RowKey"])
-                        deleteEntity("connections", e["RowKey"], e["PartitionKey"])
-                    # gear
-                    for e in queryEntities("gear", "PartitionKey eq '" + auth["userid"] + "'"):
-                        deleteEntity("gear", e["PartitionKey"], e["RowKey"])
-                    # notifications
-                    for e in queryEntities("notifications", "PartitionKey eq '" + auth["userid"] + "'"):
-                        deleteEntity("notifications", e["PartitionKey"], e["RowKey"])
-                    # deletions
-                    for e in queryEntities("deletions", "PartitionKey eq '" + auth["userid"] + "'"):
-                        deleteEntity("deletions", e["PartitionKey"], e["RowKey"])
-                    # user
-                    deleteEntity("users", auth["userid"], 'account')
-                    # log
+                    # the account is removed now so the user is signed out, everything else is deleted by cascadedelete
+                    # the job and the log row that keeps the userid from being reused are written before the account goes
+                    jobid = str(uuid.uuid4())
+                    upsertEntity("deletejobs", {"PartitionKey": auth["userid"], "RowKey": jobid, "jobtype": "user", "status": "pending", "stage": deletionStages("user")[0], "checkpoint": "", "deletedblobs": 0, "deletedentities": 0})
+                    deletequeue.set(json.dumps({"userid": auth["userid"], "jobid": jobid}))
                     upsertEntity("deletions", {
                         "PartitionKey": auth["userid"],
                         "RowKey": str(uuid.uuid4()),
                         "userid": auth["userid"]
                     })
+                    deleteEntity("users", auth["userid"], 'account')
+                    invalidateAuthorizer(auth["userid"])
+                    return createJsonHttpResponse(202, "account deletion started", {"jobid": jobid, "statusurl": "deletestatus/" + auth["userid"] + "/" + jobid})
                 else:
                     return createJsonHttpResponse(200, "to delete account, call delete/user/{deleteid}", {"deleteid": deleteid})
             case "activity":
                 qe = queryEntities("activities", "PartitionKey eq '" + auth['userid'] + "' and RowKey eq '" + req.route_params.get("id") +  "'")
                 if len(qe) != 1:
                     return createJsonHttpResponse(404, "resource not found")
-                # gear distance capture change
-                if "gearid" in qe[0].keys():
-                    if (qe[0]["gearid"] != 'none'):
-                        incrementDecrement("gear", auth["userid"], qe[0]["gearid"], "distance", -1 * qe[0].get("distance", float(0)), False)
+                # blobs, media, comments and props are deleted by cascadedelete, its job is created first so nothing is left behind
+                # if the request fails part way, and the job waits until the activity row is gone
+                jobid = str(uuid.uuid4())
+                upsertEntity("deletejobs", {"PartitionKey": auth["userid"], "RowKey": jobid, "jobtype": "activity", "activityid": req.route_params.get("id"), "status": "pending", "stage": deletionStages("activity")[0], "checkpoint": "", "deletedblobs": 0, "deletedentities": 0})
+                deletequeue.set(json.dumps({"userid": auth["userid"], "jobid": jobid}))
                 upsertEntity("deletions", {
                     "PartitionKey": auth["userid"],
                     "RowKey": str(uuid.uuid4()),
                     "activityid": req.route_params.get("id")
                 })
-                # media
-                for e in queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "'"):
-                    deleteEntity("media", e["PartitionKey"], e["RowKey"])
-                # comments
-                for e in queryEntities("comments", "PartitionKey eq '" + req.route_params.get("id") + "'"):
-                    deleteEntity("comments", e["PartitionKey"], e["RowKey"])
-                # props
-                for e in queryEntities("props", "PartitionKey eq '" + req.route_params.get("id") + "'"):
-                    deleteEntity("props", e["PartitionKey"], e["RowKey"])
                 #activity
                 deleteEntity("activities", auth["userid"], req.route_params.get("id"))
+                deleteFeedEntries(feedTargets(auth["userid"]), activityFeedKey(dict(qe[0], activityid=req.route_params.get("id"))))
+                # gear distance capture change
+                if "gearid" in qe[0].keys():
+                    if (qe[0]["gearid"] != 'none'):
+                        incrementDecrement("gear", auth["userid"], qe[0]["gearid"], "distance", -1 * qe[0].get("distance", float(0)), False)
+                # the activity is deleted at this point, totals that fail to update are repaired by create/statistics
+                try:
+                    adjustStatistics(auth["userid"], qe[0], -1, rebuild=True)
+                except Exception as ex:
+                    logging.warning("statistics not updated for " + req.route_params.get("id") + ": " + str(ex))
+                return createJsonHttpResponse(200, "delete successful", {"jobid": jobid, "statusurl": "deletestatus/" + auth["userid"] + "/" + jobid})
             case "media":
-                if len(queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey eq '" + req.route_params.get("id2") + "'")) != 1:
+                if len(queryEntities("media", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey eq '" + req.route_params.get("id2") + "' and RowKey lt '~'")) != 1:
                     return createJsonHttpResponse(404, "resource not found")
                 if len(queryEntities("activities", "PartitionKey eq '" + auth["userid"] + "' and RowKey eq '" + req.route_params.get("id") + "'")) == 0:
                     return createJsonHttpResponse(403, "must be the activity owner to delete media")
@@ -1449,8 +2905,10 @@ def delete(req: func.HttpRequest) -> func.HttpResponse:
                     "RowKey": str(uuid.uuid4()),
                     "connectionid": req.route_params.get("id")
                 })
-                deleteEntity("connections", auth["userid"], req.route_params.get("id"))
-                deleteEntity("connections", req.route_params.get("id"), auth["userid"])
+                deleteEntities("connections", [{"PartitionKey": auth["userid"], "RowKey": req.route_params.get("id")}, {"PartitionKey": req.route_params.get("id"), "RowKey": auth["userid"]}])
+                invalidateConnections([auth["userid"], req.route_params.get("id")])
+                removeFeedAuthor(auth["userid"], req.route_params.get("id"))
+                removeFeedAuthor(req.route_params.get("id"), auth["userid"])
             case "prop":
                 if len(queryEntities("props", "PartitionKey eq '" + req.route_params.get("id") + "' and RowKey eq '" + auth["userid"] + "'")) == 0:
                     return createJsonHttpResponse(400, "cannot delete prop")
@@ -1477,8 +2935,7 @@ def delete(req: func.HttpRequest) -> func.HttpResponse:
                 deleteEntity("comments", req.route_params.get("id"), req.route_params.get("id2"))
             case "notification":
                 if req.route_params.get("id").lower() == 'all':
-                    for e in queryEntities("notifications", "PartitionKey eq '" + auth["userid"] + "'", ["RowKey"], {"RowKey":"notificationid"}):
-                        deleteEntity("notifications", auth["userid"], e['notificationid'])
+                    deleteEntities("notifications", queryEntities("notifications", "PartitionKey eq '" + auth["userid"] + "'", ["PartitionKey", "RowKey"]))
                     return createJsonHttpResponse(200, "delete successful")
                 if len(queryEntities("notifications", "PartitionKey eq '" + auth["userid"] + "' and RowKey eq '" + req.route_params.get("id") + "'")) == 0:
                     return createJsonHttpResponse(400, "cannot delete notification")
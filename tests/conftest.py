@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("smoothing", "0")
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class Row(dict):
+    # table entity as returned by query_entities, with the etag conditional writes are checked against
+    def __init__(self, values, etag):
+        super().__init__(values)
+        self.metadata = {"etag": etag}
+
+
+def transactionError(status):
+    from azure.data.tables import TableTransactionError
+    ex = TableTransactionError(message="conflict")
+    ex.status_code = status
+    return ex
@@ -0,0 +1,27 @@
+import pytest
+
+import function_app
+
+
+def test_commit_runs_after_steps():
+    calls = []
+    function_app.runCommit([(lambda: calls.append("a"), None), (lambda: calls.append("b"), None)], lambda: calls.append("commit"))
+    assert sorted(calls[:2]) == ["a", "b"] and calls[2] == "commit"
+
+
+def test_failed_step_skips_commit_and_rolls_back():
+    calls = []
+    def fail():
+        raise ValueError("step")
+    with pytest.raises(ValueError):
+        function_app.runCommit([(lambda: calls.append("a"), lambda: calls.append("undo a")), (fail, lambda: calls.append("undo fail"))], lambda: calls.append("commit"))
+    assert calls == ["a", "undo a"]
+
+
+def test_failed_commit_rolls_back_every_step():
+    calls = []
+    def fail():
+        raise ValueError("commit")
+    with pytest.raises(ValueError):
+        function_app.runCommit([(lambda: calls.append("a"), lambda: calls.append("undo a")), (lambda: calls.append("b"), lambda: calls.append("undo b"))], fail)
+    assert sorted(calls) == ["a", "b", "undo a", "undo b"]
@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+import function_app
+
+
+class Request:
+    def __init__(self, params):
+        self.route_params = {"datatype": "geojson", "id": "a"}
+        self.params = params
+        self.headers = {}
+
+
+@pytest.mark.parametrize("params", [{"zoom": "abc"}, {"zoom": "-1"}, {"zoom": "1e9"}, {"zoom": "nan"}, {"tolerance": "inf"}, {"tolerance": "x"}])
+def test_invalid_level_of_detail_is_rejected(monkeypatch, params):
+    monkeypatch.setattr(function_app, "authorizer", lambda req: {"authorized": True, "userid": "u"})
+    monkeypatch.setattr(function_app, "validateData", lambda name, value: {"status": True})
+    response = function_app.data(Request(params))
+    assert response.status_code == 400
+    assert json.loads(response.get_body())["message"].startswith(list(params.keys())[0])
@@ -0,0 +1,44 @@
+import types
+
+import pytest
+
+import function_app
+
+
+class Container:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def delete_blobs(self, *names, raise_on_any_failure = True):
+        assert raise_on_any_failure == False
+        return iter([types.SimpleNamespace(status_code=self.statuses.get(n, 202)) for n in names])
+
+
+def test_blobs_already_gone_are_ignored():
+    function_app.deleteBlobBatch(Container({"b": 404}), ["a", "b"])
+
+
+def test_other_blob_failures_are_raised():
+    with pytest.raises(Exception, match="b \\(403\\)"):
+        function_app.deleteBlobBatch(Container({"b": 403}), ["a", "b", "c"])
+
+
+def test_user_stages_remove_visibility_before_data():
+    stages = function_app.deletionStages("user")
+    assert stages[0] == "snapshot" and stages[-1] == "cleanup"
+    for visible in ["connections", "feed", "activities"]:
+        assert stages.index(visible) < stages.index("blobs")
+    assert "log" not in stages
+
+
+def test_userpartitions_keeps_the_account_deletion_row(monkeypatch):
+    rows = {"deletions": [{"PartitionKey": "u", "RowKey": "1", "activityid": "a"}, {"PartitionKey": "u", "RowKey": "2", "userid": "u"}],
+            "gear": [{"PartitionKey": "u", "RowKey": "g"}]}
+    deleted = {}
+    monkeypatch.setattr(function_app, "queryEntities", lambda table, filter, properties: rows.get(table, []))
+    monkeypatch.setattr(function_app, "deleteEntities", lambda table, entities: deleted.setdefault(table, []).extend(entities))
+    job = {"PartitionKey": "u", "RowKey": "job", "jobtype": "user", "stage": "userpartitions"}
+    assert function_app.runDeletionStage(job, 0)
+    assert deleted["deletions"] == [{"PartitionKey": "u", "RowKey": "1"}]
+    assert deleted["gear"] == [{"PartitionKey": "u", "RowKey": "g"}]
+    assert job["deletedentities"] == 2
@@ -0,0 +1,36 @@
+import function_app
+
+
+class Request:
+    def __init__(self, acceptencoding):
+        self.headers = {"Accept-Encoding": acceptencoding}
+
+
+def accepts(header, encoding = "gzip"):
+    return function_app.acceptsEncoding(Request(header), encoding)
+
+
+def test_listed_encodings_are_accepted():
+    assert accepts("gzip")
+    assert accepts("br, gzip;q=0.5")
+    assert accepts("GZIP")
+    assert not accepts("br")
+    assert not accepts("")
+
+
+def test_exact_coding_takes_precedence_over_wildcard():
+    assert accepts("*;q=0, gzip")
+    assert not accepts("gzip;q=0, *")
+    assert accepts("*")
+    assert not accepts("*;q=0")
+
+
+def test_zero_q_values_refuse_the_coding():
+    for q in ["0", "0.0", "0.000"]:
+        assert not accepts("gzip;q=" + q)
+    assert accepts("gzip;q=0.001")
+
+
+def test_malformed_q_values_are_ignored():
+    assert not accepts("gzip;q=abc")
+    assert accepts("gzip;q=abc, *")
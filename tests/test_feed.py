@@ -0,0 +1,45 @@
+import function_app
+
+
+def test_feed_row_keys_read_newest_first():
+    assert function_app.feedRowKey(2000, "b") < function_app.feedRowKey(1000, "a")
+
+
+def test_stored_feedkey_is_used():
+    assert function_app.activityFeedKey({"feedkey": "k", "activityid": "a", "starttime": "2024-01-01T00:00:00Z"}) == "k"
+
+
+def test_legacy_feedkey_comes_from_starttime_without_writing(monkeypatch):
+    def write(*args, **kwargs):
+        raise AssertionError("activity written")
+    monkeypatch.setattr(function_app, "updateEntity", write)
+    monkeypatch.setattr(function_app, "upsertEntity", write)
+    activity = {"activityid": "a", "starttime": "2024-01-01T00:00:00Z", "timestamp": "2025-06-01T00:00:00Z"}
+    assert function_app.activityFeedKey(activity) == function_app.feedRowKey(1704067200, "a")
+    assert function_app.activityFeedKey(activity) == function_app.activityFeedKey(dict(activity, timestamp="2026-01-01T00:00:00Z"))
+
+
+def test_backfill_writes_entries_in_one_batch(monkeypatch):
+    activities = [{"activityid": str(i), "starttime": "2024-01-01T00:00:00Z", "visibilitytype": "connections"} for i in range(150)]
+    activities.append({"activityid": "private", "starttime": "2024-01-01T00:00:00Z", "visibilitytype": "private"})
+    submitted = []
+    monkeypatch.setattr(function_app, "queryEntities", lambda *args, **kwargs: [dict(a) for a in activities])
+    monkeypatch.setattr(function_app, "submitEntities", lambda table, operations: submitted.append((table, operations)))
+    function_app.backfillFeed("owner", "author", 0)
+    assert len(submitted) == 1 and submitted[0][0] == "feeds"
+    operations = submitted[0][1]
+    assert len(operations) == 150
+    assert all(o == "upsert" and e["PartitionKey"] == "owner" and e["userid"] == "author" for o, e in operations)
+
+
+def test_feed_since_is_kept_on_the_built_row(monkeypatch):
+    function_app.cacheInvalidate("feeds", ["u1", "u2"])
+    rows = {"u1": [{"RowKey": "~built", "since": 1000, "timestamp": "2025-01-01T00:00:00+00:00"}],
+            "u2": [{"RowKey": "~built", "timestamp": "2025-01-01T00:00:00+00:00"}]}
+    monkeypatch.setattr(function_app, "queryEntities", lambda table, filter: rows[filter.split("'")[1]])
+    monkeypatch.setenv("feedlookback", "100")
+    assert function_app.feedBuilt("u1") == 1000
+    # rows from before since was kept count back feedlookback from when they were written
+    assert function_app.feedBuilt("u2") == 1735689600 - 100
+    rows.clear()
+    assert function_app.feedBuilt("u1") == 1000
@@ -0,0 +1,41 @@
+import math
+import os
+
+import function_app
+from conftest import FIXTURES
+
+
+def gpx(points):
+    return ('<?xml version="1.0" encoding="UTF-8"?><gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>' + "".join(points) + '</trkseg></trk></gpx>').encode()
+
+
+def test_fixture_parses():
+    with open(os.path.join(FIXTURES, "ride.gpx"), "rb") as f:
+        columns = function_app.parseGpxColumns(f.read())
+    assert len(columns["timestamp"]) == 300
+    assert columns["timestamp"][0] == "2024-06-01T07:30:00Z"
+
+
+def test_empty_and_bad_elevation_are_tolerated():
+    columns = function_app.parseGpxColumns(gpx([
+        '<trkpt lat="44.1" lon="-73.1"><ele/><time>2024-06-01T07:30:00Z</time></trkpt>',
+        '<trkpt lat="44.2" lon="-73.2"><ele>n/a</ele><time>2024-06-01T07:30:02Z</time></trkpt>',
+        '<trkpt lat="44.3" lon="-73.3"><ele>-4</ele><time>2024-06-01T07:30:04Z</time></trkpt>',
+        '<trkpt lat="44.4" lon="-73.4"><ele>12.5</ele><time>2024-06-01T07:30:06Z</time></trkpt>'
+    ]))
+    elevation = columns["elevation"].tolist()
+    assert math.isnan(elevation[0])
+    assert math.isnan(elevation[1])
+    assert elevation[2:] == [0.0, 12.5]
+    data = function_app.columnsToActivityData(columns)["data"]
+    assert "elevation" not in data[0]
+    assert data[3]["elevation"] == 12.5
+
+
+def test_missing_time_is_rejected():
+    try:
+        function_app.parseGpxColumns(gpx(['<trkpt lat="44.1" lon="-73.1"><ele>1</ele></trkpt>']))
+    except Exception as ex:
+        assert "required" in str(ex)
+    else:
+        assert False
@@ -0,0 +1,50 @@
+import function_app
+from conftest import Row, transactionError
+
+
+class MediaTable:
+    # one media partition, before runs ahead of each transaction to stand in for a concurrent upload
+    def __init__(self, rows, before = None):
+        self.rows = {r["RowKey"]: Row(r, "e0") for r in rows}
+        self.before = before
+        self.submits = 0
+
+    def query_entities(self, filter):
+        return [r for k, r in self.rows.items() if k == "~sort"]
+
+    def submit_transaction(self, operations):
+        self.submits += 1
+        if self.before != None:
+            before = self.before
+            self.before = None
+            before(self)
+        for operation in operations:
+            current = self.rows.get(operation[1]["RowKey"])
+            if (operation[0] == "create" and current != None) or (operation[0] == "update" and current.metadata["etag"] != operation[2]["etag"]):
+                raise transactionError(409 if operation[0] == "create" else 412)
+        for operation in operations:
+            self.rows[operation[1]["RowKey"]] = Row(operation[1], "e" + str(self.submits))
+
+
+def media(mediaid):
+    return {"PartitionKey": "a", "RowKey": mediaid, "mediastatus": "pending"}
+
+
+def test_sorts_continue_from_existing_media(monkeypatch):
+    table = MediaTable([])
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    monkeypatch.setattr(function_app, "queryEntities", lambda *args, **kwargs: [{"sort": 4}, {"sort": 2}])
+    function_app.createMediaEntities("a", [media("m1"), media("m2")])
+    assert [table.rows["m1"]["sort"], table.rows["m2"]["sort"], table.rows["~sort"]["sort"]] == [5, 6, 6]
+
+
+def test_concurrent_upload_gets_the_next_sorts(monkeypatch):
+    def concurrent(table):
+        table.rows["other"] = Row(dict(media("other"), sort=8), "x")
+        table.rows["~sort"] = Row({"PartitionKey": "a", "RowKey": "~sort", "sort": 8}, "x")
+    table = MediaTable([{"PartitionKey": "a", "RowKey": "~sort", "sort": 7}], concurrent)
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    function_app.createMediaEntities("a", [media("m1")])
+    assert table.submits == 2
+    assert table.rows["m1"]["sort"] == 9
+    assert table.rows["~sort"]["sort"] == 9
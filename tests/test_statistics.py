@@ -0,0 +1,144 @@
+import copy
+import os
+import statistics
+
+import numpy
+import pytest
+from dateutil import parser
+from geographiclib.geodesic import Geodesic
+
+import function_app
+from conftest import FIXTURES
+
+
+def legacyStatistics(in_activitydata, smoothing):
+    # parseStatisticsData as it was before the numpy columns, kept as the reference
+    sactivitydata = copy.deepcopy(in_activitydata)
+    statisticsdata = {}
+
+    mintime = parser.parse(sactivitydata[0]["timestamp"])
+    maxtime = parser.parse(sactivitydata[len(sactivitydata)-1]["timestamp"])
+
+    distance = 0.0
+    ascent = 0.0
+    descent = 0.0
+
+    if smoothing > 0:
+        for i in range(len(sactivitydata)-1):
+            filterdata = []
+            for j in range(max(i - smoothing, 0), min(i + smoothing, len(sactivitydata)-1)):
+                filterdata.append(sactivitydata[j]["elevation"])
+            sactivitydata[i]["elevation"] = round(statistics.mean(filterdata))
+
+    for i in range(len(sactivitydata)-1):
+        x1 = sactivitydata[i]["longitude"]
+        y1 = sactivitydata[i]["latitude"]
+        x2 = sactivitydata[i+1]["longitude"]
+        y2 = sactivitydata[i+1]["latitude"]
+        distance += Geodesic.WGS84.Inverse(y1, x1, y2, x2)['s12']
+        if (sactivitydata[i+1]["elevation"] > sactivitydata[i]["elevation"]):
+            ascent += sactivitydata[i+1]["elevation"] - sactivitydata[i]["elevation"]
+        else:
+            descent += sactivitydata[i]["elevation"] - sactivitydata[i+1]["elevation"]
+
+    statisticsdata["starttime"] = mintime
+    statisticsdata["time"] = (maxtime - mintime).seconds
+    statisticsdata["distance"] = distance
+    statisticsdata["ascent"] = ascent
+    statisticsdata["descent"] = descent
+    return statisticsdata
+
+
+@pytest.fixture
+def activitydata():
+    with open(os.path.join(FIXTURES, "ride.gpx"), "rb") as f:
+        columns = function_app.parseGpxColumns(f.read())
+    return function_app.columnsToActivityData(columns)["data"]
+
+
+def test_columns_match_activitydata(activitydata):
+    columns = function_app.activityDataColumns(activitydata)
+    assert columns["timestamp"] == [d["timestamp"] for d in activitydata]
+    assert columns["longitude"].tolist() == [d["longitude"] for d in activitydata]
+    assert columns["latitude"].tolist() == [d["latitude"] for d in activitydata]
+    assert columns["elevation"].tolist() == [d["elevation"] for d in activitydata]
+
+
+def test_missing_elevation_is_nan():
+    columns = function_app.activityDataColumns([{"timestamp": "2024-06-01T07:30:00Z", "longitude": 1.0, "latitude": 2.0}])
+    assert numpy.isnan(columns["elevation"][0])
+
+
+def test_segment_distances_match_geographiclib(activitydata):
+    columns = function_app.activityDataColumns(activitydata)
+    distances = function_app.segmentDistances(columns["longitude"], columns["latitude"], "geodesic")
+    expected = [Geodesic.WGS84.Inverse(a["latitude"], a["longitude"], b["latitude"], b["longitude"])["s12"] for a, b in zip(activitydata, activitydata[1:])]
+    assert distances.tolist() == pytest.approx(expected, abs=1e-6)
+
+
+def test_haversine_within_half_percent(activitydata):
+    columns = function_app.activityDataColumns(activitydata)
+    geodesic = function_app.segmentDistances(columns["longitude"], columns["latitude"], "geodesic").sum()
+    haversine = function_app.segmentDistances(columns["longitude"], columns["latitude"], "haversine").sum()
+    assert haversine == pytest.approx(geodesic, rel=0.005)
+
+
+def test_statistics_match_legacy_without_smoothing(activitydata, monkeypatch):
+    monkeypatch.setenv("smoothing", "0")
+    expected = legacyStatistics(activitydata, 0)
+    actual = function_app.parseStatisticsData(activitydata, "geodesic")
+    assert actual["starttime"] == expected["starttime"]
+    assert actual["time"] == expected["time"]
+    assert actual["distance"] == pytest.approx(expected["distance"], abs=1e-6)
+    assert actual["ascent"] == pytest.approx(expected["ascent"], abs=1e-9)
+    assert actual["descent"] == pytest.approx(expected["descent"], abs=1e-9)
+
+
+def test_statistics_distance_unaffected_by_smoothing(activitydata, monkeypatch):
+    monkeypatch.setenv("smoothing", "5")
+    expected = legacyStatistics(activitydata, 5)
+    actual = function_app.parseStatisticsData(activitydata, "geodesic")
+    assert actual["time"] == expected["time"]
+    assert actual["distance"] == pytest.approx(expected["distance"], abs=1e-6)
+
+
+def test_smoothing_is_moving_average_of_unsmoothed_values():
+    # the old loop smoothed in place, so each point averaged neighbours that had already been smoothed
+    # smoothElevation averages the original values over [i - smoothing, i + smoothing) and leaves the last point
+    elevation = numpy.array([0.0, 10.0, 0.0, 10.0, 0.0, 10.0])
+    expected = [0.0, 5.0, 5.0, 5.0, 5.0, 10.0]
+    assert function_app.smoothElevation(elevation, 1).tolist() == expected
+    assert function_app.smoothElevation(elevation, 2).tolist() == [5.0, 3.0, 5.0, 5.0, 3.0, 10.0]
+
+    legacy = [{"elevation": e} for e in elevation.tolist()]
+    for i in range(len(legacy)-1):
+        filterdata = [legacy[j]["elevation"] for j in range(max(i - 2, 0), min(i + 2, len(legacy)-1))]
+        legacy[i]["elevation"] = round(statistics.mean(filterdata))
+    assert [d["elevation"] for d in legacy] != function_app.smoothElevation(elevation, 2).tolist()
+
+
+def test_smoothing_disabled_or_short_track_is_unchanged():
+    elevation = numpy.array([1.0, 2.0, 3.0])
+    assert function_app.smoothElevation(elevation, 0).tolist() == [1.0, 2.0, 3.0]
+    assert function_app.smoothElevation(elevation[:1], 3).tolist() == [1.0]
+
+
+def test_descent_is_not_negative_zero():
+    columns = {"timestamp": ["2024-06-01T07:30:00Z", "2024-06-01T07:30:02Z"], "longitude": numpy.array([1.0, 1.0001]), "latitude": numpy.array([2.0, 2.0]), "elevation": numpy.array([5.0, 6.0])}
+    assert str(function_app.parseStatisticsColumns(columns, "haversine")["descent"]) == "0.0"
+
+
+def test_missing_elevations_add_no_climb(monkeypatch):
+    monkeypatch.setenv("smoothing", "0")
+    with open(os.path.join(FIXTURES, "gaps.gpx"), "rb") as f:
+        columns = function_app.parseGpxColumns(f.read())
+    assert numpy.isnan(columns["elevation"]).sum() == 3
+    statistics = function_app.parseStatisticsColumns(columns, "geodesic")
+    assert statistics["ascent"] == 0.0
+    assert statistics["descent"] == 0.0
+
+
+def test_missing_elevations_are_interpolated():
+    filled = function_app.fillElevation(numpy.array([numpy.nan, 10.0, numpy.nan, 20.0, numpy.nan]))
+    assert filled.tolist() == [10.0, 10.0, 15.0, 20.0, 20.0]
+    assert function_app.fillElevation(numpy.array([numpy.nan, numpy.nan])).tolist() == [0.0, 0.0]
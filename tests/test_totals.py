@@ -0,0 +1,98 @@
+import function_app
+from conftest import Row, transactionError
+
+
+class StatisticsTable:
+    # partition of statistics rows with etags, conflicts is how many submits fail before one succeeds
+    def __init__(self, rows, conflicts = 0):
+        self.rows = {r["RowKey"]: Row(r, "e0") for r in rows}
+        self.conflicts = conflicts
+        self.submits = 0
+
+    def query_entities(self, filter):
+        return list(self.rows.values())
+
+    def submit_transaction(self, operations):
+        self.submits += 1
+        if self.conflicts > 0:
+            self.conflicts -= 1
+            raise transactionError(412)
+        for operation in operations:
+            assert operation[0] == "create" or operation[2]["etag"] == self.rows[operation[1]["RowKey"]].metadata["etag"]
+            self.rows[operation[1]["RowKey"]] = Row(operation[1], "e" + str(self.submits))
+
+
+def totals(count, distance):
+    return {"count": count, "ascent": 0.0, "descent": 0.0, "distance": distance, "time": 0}
+
+
+def test_adjust_retries_after_conflict(monkeypatch):
+    table = StatisticsTable([dict(totals(2, 10.0), PartitionKey="u", RowKey="all"), dict(totals(2, 10.0), PartitionKey="u", RowKey="activitytype_ride")], conflicts=2)
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    function_app.adjustStatistics("u", {"activitytype": "ride", "distance": 5.0}, 1)
+    assert table.submits == 3
+    assert table.rows["all"]["count"] == 3
+    assert table.rows["all"]["distance"] == 15.0
+    assert table.rows["activitytype_ride"]["distance"] == 15.0
+
+
+def test_adjust_creates_missing_type_row(monkeypatch):
+    table = StatisticsTable([dict(totals(1, 4.0), PartitionKey="u", RowKey="all")])
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    function_app.adjustStatistics("u", {"activitytype": "run", "distance": 2.0}, 1)
+    assert table.rows["activitytype_run"]["count"] == 1
+    assert table.rows["all"]["distance"] == 6.0
+
+
+def test_adjust_gives_up_after_attempts(monkeypatch):
+    table = StatisticsTable([dict(totals(1, 4.0), PartitionKey="u", RowKey="all")], conflicts=100)
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    monkeypatch.setenv("statisticsattempts", "3")
+    try:
+        function_app.adjustStatistics("u", {"activitytype": "run", "distance": 2.0}, 1)
+    except Exception as ex:
+        assert "too often" in str(ex)
+    else:
+        assert False
+    assert table.submits == 3
+
+
+def test_adjust_without_totals_does_nothing_unless_rebuilding(monkeypatch):
+    table = StatisticsTable([])
+    rebuilt = []
+    monkeypatch.setattr(function_app, "getTableClient", lambda name: table)
+    monkeypatch.setattr(function_app, "rebuildStatistics", lambda userid: rebuilt.append(userid))
+    function_app.adjustStatistics("u", {"activitytype": "run"}, 1)
+    assert table.submits == 0 and rebuilt == []
+    function_app.adjustStatistics("u", {"activitytype": "run"}, 1, rebuild=True)
+    assert rebuilt == ["u"]
+
+
+class Message:
+    def __init__(self, body):
+        self.body = body
+
+    def get_body(self):
+        return self.body.encode()
+
+
+class Out:
+    def set(self, value):
+        self.value = value
+
+
+def test_rebuild_fans_out_to_every_account(monkeypatch):
+    monkeypatch.setattr(function_app, "queryEntities", lambda table, filter, properties: [{"PartitionKey": "a"}, {"PartitionKey": "b"}])
+    out = Out()
+    function_app.statisticsrebuild(Message('{"allusers": true}'), out)
+    assert out.value == ['{"userid": "a"}', '{"userid": "b"}']
+
+
+def test_rebuild_skips_users_with_totals_unless_forced(monkeypatch):
+    rebuilt = []
+    monkeypatch.setattr(function_app, "queryEntities", lambda table, filter, properties: [{"RowKey": "all"}])
+    monkeypatch.setattr(function_app, "rebuildStatistics", lambda userid: rebuilt.append(userid))
+    function_app.statisticsrebuild(Message('{"userid": "u"}'), Out())
+    assert rebuilt == []
+    function_app.statisticsrebuild(Message('{"userid": "u", "force": true}'), Out())
+    assert rebuilt == ["u"]